@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+#==============================================================================
+#title           :lml-benchmark.py
+#description     :Offline benchmark of lml-retrieve.py: generates a synthetic
+#                 network, serves its files from a local stub of the LML
+#                 server (lml-stub-server.py), and runs lml-retrieve.py end to
+#                 end for a cold load, an hourly update and changed files.
+#version         :1.0
+#usage           :python benchmark/lml-benchmark.py [stations] [sensors] [hours]
+#                 {options}
+#notes           :Needs a database of its own (see sos_minimal.sql): the
+#                 network, the lml_import data and the sos tables are replaced.
+#python_version  :2.7.x
+#==============================================================================
+
+import os, sys, time, subprocess
+import psycopg2
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+BASEDIR = os.path.dirname(BENCHDIR)
+sys.path.insert(0, BASEDIR)
+from sos_config import *
+
+print """Offline benchmark of the LML import
+"""
+
+if len(sys.argv) < 4 or not sys.argv[1].isdigit() or not sys.argv[2].isdigit() or not sys.argv[3].isdigit():
+  print """Usage: lml-benchmark stations sensors hours {--latency=ms} {--404=rate} {--timeout=rate} {--empty=rate} {--changed=fraction} {--workers=n} {--ratelimit=n} {--httptimeout=s} {--port=n} {--set=key=value} {--force}
+  stations:      Number of stations of the synthetic network.
+  sensors:       Number of sensors, every station measures all of them.
+  hours:         Hours downloaded per run (timeframe), files per run is
+                 sensors * hours, measurements per run is stations times that.
+  --latency:     Delay of every response of the stub server in ms (default 0).
+  --404:         Fraction of the requests answered with 404 (default 0).
+  --timeout:     Fraction of the requests without an answer (default 0).
+  --empty:       Fraction of the requests with an empty body (default 0).
+  --changed:     Fraction of the files changed in the changed-file scenario
+                 (default 0.05).
+  --workers:     Sets lml.retrieve.workers (concurrent downloads).
+  --ratelimit:   Sets http.ratelimit (requests per second, default 0: the
+                 stub server needs no protection).
+  --httptimeout: Sets http.timeout (seconds).
+  --port:        Port of the stub server (default 8765).
+  --set:         Sets a configuration key, e.g. --set=sos.publish.setbased=T
+                 (more than once allowed).
+  --force:       Run even when the database holds files of a real LML server.
+
+Scenarios:
+  cold-load:     Empty cache, all files of the timeframe are new (the files of
+                 the last hour are not there yet).
+  hourly-update: Same timeframe again, the files of the last hour are new,
+                 the other files are not modified (http 304).
+  changed-file:  A fraction of the files changed, they are replaced and
+                 published again.
+"""
+  sys.exit()
+
+STATIONS = int(sys.argv[1])
+SENSORS = int(sys.argv[2])
+HOURS = int(sys.argv[3])
+OPTIONS = dict(arg[2:].split("=", 1) for arg in sys.argv[4:] if arg.startswith("--") and arg.find("=") > 0 and not arg.startswith("--set="))
+SETTINGS = [arg[6:].split("=", 1) for arg in sys.argv[4:] if arg.startswith("--set=") and arg.find("=", 6) > 0]
+FORCE = '--force' in sys.argv
+PORT = int(OPTIONS.get('port', 8765))
+CHANGED = OPTIONS.get('changed', '0.05')
+STUBERRORS = ["--" + key + "=" + OPTIONS[key] for key in ('latency', '404', 'timeout', 'empty') if key in OPTIONS]
+
+# Read optional configuration keys from database
+# (returns the default when the key is not present or null)
+def GetConfigFromDbDefault(pgcur, key, default):
+  sql = "SELECT configvalue FROM configuration WHERE key = %s;"
+  pgcur.execute(sql, (key, ))
+  result = pgcur.fetchone()
+  if result == None or result[0] == None:
+    return default
+  return result[0]
+
+# Set a configuration key (added when not present)
+def SetConfig(pgcur, key, value):
+  sql = "UPDATE configuration SET configvalue = %s WHERE key = %s;"
+  pgcur.execute(sql, (value, key))
+  if pgcur.rowcount == 0:
+    sql = "INSERT INTO configuration (key, configvalue) VALUES (%s, %s);"
+    pgcur.execute(sql, (key, value))
+
+# Refuse to wipe a database that downloads from a real LML server
+def CheckDatabase(pgcur):
+  server = GetConfigFromDbDefault(pgcur, 'lml.server.httpaddress', '')
+  pgcur.execute("SELECT EXISTS (SELECT 1 FROM xml_files);")
+  if pgcur.fetchone()[0] and not server.startswith("http://127.0.0.1:") and not FORCE:
+    print "This database holds files of " + server + ", use a database of its own (or --force)."
+    sys.exit(1)
+
+# Empty the cache and the sos tables (no triggers, nothing is unpublished)
+def EmptyTables(pgcur):
+  pgcur.execute("""TRUNCATE measurements, measurements_staging, xml_files, download_failures, message_log,
+    series_dirty, unpublish_pending, publish_targets, backfill_days;""")
+  pgcur.execute("""TRUNCATE sos.numericvalue, sos.observationhasoffering, sos.observation, sos.series,
+    sos.offering, sos.procedure, sos.featureofinterest, sos.observableproperty;""")
+  pgcur.execute("TRUNCATE statsensunit, stations_eionet, sensors;")
+
+# Synthetic network: 'stations' stations (codes 1001, 1002, ..., same as the stub
+# server) measuring all 'sensors' sensors (BM01, BM02, ...), all published
+def GenerateNetwork(pgcur, stations, sensors):
+  sql = """INSERT INTO sensors (id, sensorcode, description, download)
+    SELECT i, 'BM' || lpad(i::text, 2, '0'), 'Benchmark sensor ' || i, true
+    FROM generate_series(1, %s) i;"""
+  pgcur.execute(sql, (sensors, ))
+  sql = """INSERT INTO stations_eionet (id, gmlid, localid, namespace, version, natlstationcode, name, municipality,
+      eustationcode, activitybegin, pos, srsname, altitude, altitudeunit, areaclassification, belongsto, geom)
+    SELECT i, 'STA.NL' || (9000 + i), 'STA.NL' || (9000 + i), 'NL.RIVM.AQ', '1', (1000 + i)::text, 'Station ' || (1000 + i), 'Benchmark',
+      'NL' || (90000 + i), '2000-01-01T00:00:00+01:00', (50.8 + (i %% 25) * 0.1) || ' ' || (3.5 + (i / 25 %% 30) * 0.1), 'urn:ogc:def:crs:EPSG::4258', 0, 'm',
+      'http://dd.eionet.europa.eu/vocabulary/aq/areaclassification/rural', 'NET.NL.BENCHMARK',
+      public.ST_SetSRID(public.ST_MakePoint(3.5 + (i / 25 %% 30) * 0.1, 50.8 + (i %% 25) * 0.1, 0), 4326)
+    FROM generate_series(1, %s) i;"""
+  pgcur.execute(sql, (stations, ))
+  sql = """INSERT INTO statsensunit (id, station_id, sensor_id, unit_id, publish_sos)
+    SELECT row_number() OVER (ORDER BY st.id, se.id), st.id, se.id, (SELECT min(id) FROM units), true
+    FROM stations_eionet st, sensors se;"""
+  pgcur.execute(sql)
+
+# The SOS side of the network, as lml-prepare.py would have inserted it through the
+# SOS-T interface: units, observable properties, features, procedures, offerings, series
+def PrepareSos(pgcur):
+  pgcur.execute("""INSERT INTO sos.unit (unit)
+    SELECT DISTINCT m_unit FROM units
+    ON CONFLICT DO NOTHING;""")
+  pgcur.execute("""INSERT INTO sos.observableproperty (identifier)
+    SELECT DISTINCT (SELECT uri FROM uribase WHERE key = 'observableproperty') || sensorcode
+    FROM vw_statsensunit WHERE publish_sos;""")
+  pgcur.execute("""INSERT INTO sos.featureofinterest (identifier, name, geom)
+    SELECT DISTINCT ON (publishstationcode) (SELECT uri FROM uribase WHERE key = 'featureofinterest') || publishstationcode, name, geom
+    FROM vw_statsensunit WHERE publish_sos;""")
+  pgcur.execute("""INSERT INTO sos.procedure (identifier)
+    SELECT (SELECT uri FROM uribase WHERE key = 'procedure') || publishstationcode || '/' || sensorcode
+    FROM vw_statsensunit WHERE publish_sos;""")
+  pgcur.execute("""INSERT INTO sos.offering (identifier)
+    SELECT (SELECT uri FROM uribase WHERE key = 'offering') || publishstationcode || '/' || sensorcode
+    FROM vw_statsensunit WHERE publish_sos;""")
+  pgcur.execute("""INSERT INTO sos.series (featureofinterestid, observablepropertyid, procedureid, unitid)
+    SELECT f.featureofinterestid, o.observablepropertyid, p.procedureid, u.unitid
+    FROM vw_statsensunit v
+    JOIN sos.featureofinterest f
+      ON f.identifier = (SELECT uri FROM uribase WHERE key = 'featureofinterest') || v.publishstationcode
+    JOIN sos.observableproperty o
+      ON o.identifier = (SELECT uri FROM uribase WHERE key = 'observableproperty') || v.sensorcode
+    JOIN sos.procedure p
+      ON p.identifier = (SELECT uri FROM uribase WHERE key = 'procedure') || v.publishstationcode || '/' || v.sensorcode
+    JOIN sos.unit u
+      ON u.unit = v.m_unit
+    WHERE v.publish_sos;""")
+  pgcur.execute("SELECT refresh_publish_targets();")
+
+# Number of observation ids handed out so far (observations published, in every
+# publish mode)
+def GetObservationCount(pgcur):
+  pgcur.execute("SELECT CASE WHEN is_called THEN last_value ELSE last_value - 1 END FROM sos.observationid_seq;")
+  return pgcur.fetchone()[0]
+
+# The metrics of a run of lml-retrieve.py (run_metrics)
+def GetRunMetrics(pgcur, runid):
+  sql = "SELECT metric, value FROM run_metrics WHERE run_id = %s;"
+  pgcur.execute(sql, (runid, ))
+  return dict(pgcur.fetchall())
+
+# Run a script of the import, returns (seconds, output)
+def RunScript(script, args):
+  env = dict(os.environ)
+  env.pop('http_proxy', None)
+  start = time.time()
+  p = subprocess.Popen([sys.executable, os.path.join(BASEDIR, script)] + args, cwd=BASEDIR, env=env,
+    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+  output = p.communicate()[0]
+  if p.returncode != 0:
+    print output
+    print "Error: " + script + " failed (exit code " + str(p.returncode) + ")"
+    sys.exit(1)
+  return (time.time() - start, output)
+
+# One scenario: stub server with the given options, lml-retrieve.py for the timeframe
+# (and lml-process.py when processing is deferred); returns the results
+def RunScenario(pgcur, name, stubargs, deferred):
+  print "Scenario " + name + "..."
+  stub = subprocess.Popen([sys.executable, os.path.join(BENCHDIR, 'lml-stub-server.py'), str(PORT), str(STATIONS)] + stubargs + STUBERRORS,
+    stdout=subprocess.PIPE)
+  if stub.stdout.readline() == "": # listening
+    print "Error: stub server not started (port " + str(PORT) + " in use?)"
+    sys.exit(1)
+  try:
+    observations = GetObservationCount(pgcur)
+    conn.commit()
+    seconds, output = RunScript('lml-retrieve.py', [str(HOURS), str(HOURS)])
+    processseconds = 0
+    if deferred:
+      processseconds, processoutput = RunScript('lml-process.py', [])
+    published = GetObservationCount(pgcur) - observations
+  finally:
+    stub.terminate()
+    stub.wait()
+  runid = [line.split("(run ")[1].rstrip(")") for line in output.splitlines() if line.startswith("Metrics stored (run ")]
+  if len(runid) == 0:
+    print output
+    print "Error: no metrics of lml-retrieve.py"
+    sys.exit(1)
+  result = GetRunMetrics(pgcur, runid[0])
+  conn.commit()
+  result['scenario'] = name
+  result['files'] = sum([result.get('files.' + key, 0) for key in ('new', 'updated', 'unchanged', 'unchanged.md5', 'notmodified', 'failed', 'other')])
+  result['measurements'] = published
+  result['phase.process'] = processseconds
+  result['seconds'] = seconds + processseconds
+  return result
+
+# Report of the scenarios: throughput and time per phase
+def PrintReport(results):
+  print ""
+  print "%-14s %7s %8s %12s %10s %9s %8s %8s %8s %8s" % ("scenario", "files", "files/s", "measurements", "meas./s", "downloads", "retries", "series", "process", "total")
+  for r in results:
+    seconds = max(r['seconds'], 0.001)
+    print "%-14s %7d %8.1f %12d %10.1f %9.2f %8.2f %8.2f %8.2f %8.2f" % (r['scenario'], r['files'], r['files'] / seconds,
+      r['measurements'], r['measurements'] / seconds, r.get('phase.downloads', 0), r.get('phase.retries', 0),
+      r.get('phase.updateseries', 0), r['phase.process'], seconds)
+  print ""
+  print "%-14s %7s %9s %9s %11s %8s %9s %8s" % ("scenario", "new", "updated", "unchanged", "notmodified", "failed", "store (s)", "p90 (ms)")
+  for r in results:
+    print "%-14s %7d %9d %9d %11d %8d %9.2f %8.1f" % (r['scenario'], r.get('files.new', 0), r.get('files.updated', 0),
+      r.get('files.unchanged', 0) + r.get('files.unchanged.md5', 0), r.get('files.notmodified', 0), r.get('files.failed', 0),
+      r.get('time.store', 0), r.get('http.latency.p90', 0) * 1000)
+
+# Open global database connection
+conn_string = "host='"+DBHOST+"' port='"+DBPORT+"' dbname='"+DATABASE+"' user='"+DBUSER+"' password='" + DBPWD + "'"
+print "Connecting to database..."
+conn = psycopg2.connect(conn_string)
+cursor = conn.cursor()
+cursor.execute("SET search_path = " + SCHEMA + ",public;")
+conn.commit()
+print "Connected!\n"
+
+CheckDatabase(cursor)
+print "Generating network: " + str(STATIONS) + " stations, " + str(SENSORS) + " sensors, " + str(HOURS) + " hours per run"
+EmptyTables(cursor)
+GenerateNetwork(cursor, STATIONS, SENSORS)
+PrepareSos(cursor)
+SetConfig(cursor, 'lml.server.httpaddress', "http://127.0.0.1:" + str(PORT))
+SetConfig(cursor, 'lml.server.directory', "/")
+SetConfig(cursor, 'http.proxy', "")
+SetConfig(cursor, 'http.ratelimit', OPTIONS.get('ratelimit', "0"))
+if 'workers' in OPTIONS:
+  SetConfig(cursor, 'lml.retrieve.workers', OPTIONS['workers'])
+if 'httptimeout' in OPTIONS:
+  SetConfig(cursor, 'http.timeout', OPTIONS['httptimeout'])
+for key, value in SETTINGS:
+  SetConfig(cursor, key, value)
+deferred = GetConfigFromDbDefault(cursor, 'lml.process.deferred', 'F') == 'T'
+conn.commit()
+
+results = []
+results.append(RunScenario(cursor, 'cold-load', ['--lag=1'], deferred))
+results.append(RunScenario(cursor, 'hourly-update', [], deferred))
+results.append(RunScenario(cursor, 'changed-file', ['--changed=' + CHANGED], deferred))
+PrintReport(results)
+
+conn.close()
+# The end
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+#==============================================================================
+#title           :lml-stub-server.py
+#description     :Local stand in for the LML web server, for the offline
+#                 benchmark: serves generated <ROWSET> files for every
+#                 requested hour and sensor, with configurable latency and
+#                 errors (404, time outs, empty bodies).
+#version         :1.0
+#usage           :python lml-stub-server.py port stations [options]
+#notes           :Started by lml-benchmark.py, one server per scenario. The
+#                 contents only depend on the file name, the station count
+#                 and --changed, so a second run serves the same files.
+#python_version  :2.7.x
+#==============================================================================
+
+import sys, time, random, hashlib
+import BaseHTTPServer, SocketServer
+from datetime import datetime
+from datetime import timedelta
+from email.utils import formatdate
+from calendar import timegm
+import _strptime # before the threads start (strptime is not thread safe on first use)
+
+if len(sys.argv) < 3:
+  print """Usage: lml-stub-server port stations {--latency=ms} {--404=rate} {--timeout=rate} {--empty=rate} {--changed=fraction} {--lag=hours}
+  port:       Port to listen on (127.0.0.1).
+  stations:   Number of stations in every file (station codes 1001, 1002, ...).
+  --latency:  Delay of every response in milliseconds (default 0).
+  --404:      Fraction of the requests answered with 404 (default 0).
+  --timeout:  Fraction of the requests that never get an answer in time
+              (the server waits 120 s, default 0).
+  --empty:    Fraction of the requests answered with an empty body (default 0).
+  --changed:  Fraction of the files with other values than in a run without
+              this option (a new version of the file, default 0).
+  --lag:      Files of the last 'lag' hours are not there yet, 404 (default 0).
+"""
+  sys.exit()
+
+PORT = int(sys.argv[1])
+STATIONS = int(sys.argv[2])
+OPTIONS = dict(arg[2:].split("=", 1) for arg in sys.argv[3:] if arg.startswith("--") and arg.find("=") > 0)
+LATENCY = float(OPTIONS.get('latency', 0)) / 1000
+RATE404 = float(OPTIONS.get('404', 0))
+RATETIMEOUT = float(OPTIONS.get('timeout', 0))
+RATEEMPTY = float(OPTIONS.get('empty', 0))
+CHANGED = float(OPTIONS.get('changed', 0))
+LAG = int(OPTIONS.get('lag', 0))
+TIMEOUTDELAY = 120
+
+# Station codes of the synthetic network (same as lml-benchmark.py)
+def StationCodes(stations):
+  return [str(1000 + i) for i in range(1, stations + 1)]
+
+# Deterministic number in [0, 1) for a text
+def Fraction(text):
+  return int(hashlib.md5(text).hexdigest()[:8], 16) / float(0x100000000)
+
+# The <ROWSET> of a file: one ROW per station, values depend on the file name
+# and the version of the file
+def MakeXml(filename, filetime, version):
+  begin = filetime.strftime("%Y%m%d%H%M%S")
+  end = (filetime + timedelta(hours = 1)).strftime("%Y%m%d%H%M%S")
+  rows = ["<ROWSET>\n"]
+  for code in StationCodes(STATIONS):
+    value = round(Fraction(filename + code + version) * 200, 2)
+    rows.append(""" <ROW>
+  <OPST_OPDR_ORGA_CODE>RIVM</OPST_OPDR_ORGA_CODE>
+  <STAT_NUMMER>%s</STAT_NUMMER>
+  <STAT_NAAM>Station %s</STAT_NAAM>
+  <MCLA_CODE>regio achtergr</MCLA_CODE>
+  <MWAA_WAARDE>%s</MWAA_WAARDE>
+  <MWAA_BEGINDATUMTIJD>%s</MWAA_BEGINDATUMTIJD>
+  <MWAA_EINDDATUMTIJD>%s</MWAA_EINDDATUMTIJD>
+ </ROW>
+""" % (code, code, value, begin, end))
+  rows.append("</ROWSET>\n")
+  return "".join(rows)
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1" # keep-alive, as the LML server
+
+  def log_message(self, format, *args):
+    pass
+
+  def Respond(self, status, body="", headers={}):
+    self.send_response(status)
+    for key, value in headers.items():
+      self.send_header(key, value)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def do_GET(self):
+    if LATENCY > 0:
+      time.sleep(LATENCY)
+    filename = self.path.split("/")[-1]
+    try:
+      filetime = datetime.strptime(filename.split("-")[0], "%Y%m%d%H")
+    except ValueError:
+      self.Respond(404)
+      return
+    if filetime > datetime.now() - timedelta(hours = LAG):
+      self.Respond(404)
+      return
+    draw = random.random()
+    if draw < RATE404:
+      self.Respond(404)
+      return
+    if draw < RATE404 + RATETIMEOUT:
+      time.sleep(TIMEOUTDELAY)
+      self.close_connection = 1
+      return
+    if draw < RATE404 + RATETIMEOUT + RATEEMPTY:
+      self.Respond(200)
+      return
+    version = ""
+    if Fraction(filename + "changed") < CHANGED:
+      version = "changed"
+    data = MakeXml(filename, filetime, version)
+    etag = '"' + hashlib.md5(data).hexdigest() + '"'
+    if self.headers.getheader('If-None-Match') == etag:
+      self.Respond(304, "", {"ETag": etag})
+      return
+    lastmodified = formatdate(timegm((filetime + timedelta(hours = 1)).timetuple()), usegmt=True)
+    self.Respond(200, data, {"Content-Type": "text/xml", "ETag": etag, "Last-Modified": lastmodified})
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+server = StubServer(("127.0.0.1", PORT), StubHandler)
+print "LML stub server on port " + str(PORT) + ", " + str(STATIONS) + " stations"
+sys.stdout.flush()
+try:
+  server.serve_forever()
+except KeyboardInterrupt:
+  pass
+# The end
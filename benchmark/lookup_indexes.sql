@@ -0,0 +1,100 @@
+--
+-- Before/after timing of the lml_import lookup indexes (lml_import-upgrade.sql)
+--
+-- Runs on a synthetic dataset in temporary tables, the lml_import data is not touched:
+--   psql -f benchmark/lookup_indexes.sql -d <sosdatabase>
+-- Scale with: psql -v files=100000 -v lookups=2000 -f ...
+-- Every xml file holds 40 measurements (stations), 2% of the files are download failures.
+--
+
+\set ON_ERROR_STOP 1
+\if :{?files}
+\else
+  \set files 50000
+\endif
+\if :{?lookups}
+\else
+  \set lookups 1000
+\endif
+
+SET client_min_messages = notice;
+
+CREATE TEMP TABLE xml_files (LIKE lml_import.xml_files INCLUDING DEFAULTS);
+CREATE TEMP TABLE measurements (LIKE lml_import.measurements INCLUDING DEFAULTS);
+CREATE TEMP TABLE download_failures (LIKE lml_import.download_failures INCLUDING DEFAULTS);
+
+INSERT INTO xml_files (id, xmlfilename, xmldatachksum, component, ts_xmlfile, ts_created, ts_processed)
+  SELECT i, to_char(timestamp '2014-01-01' + (i / 8) * interval '1 hour', 'YYYYMMDDHH24') || '-S' || (i % 8) || '.xml'
+    , md5(i::text), 'S' || (i % 8), timestamp '2014-01-01' + (i / 8) * interval '1 hour', now(), now()
+  FROM generate_series(1, :files) i;
+
+INSERT INTO measurements (id, xmlfilename, station_id, sensorcode, m_value, begindatetime, enddatetime, sos_observationid)
+  SELECT f.id * 40 + s, f.xmlfilename, s, f.component, random() * 100, f.ts_xmlfile, f.ts_xmlfile + interval '1 hour', f.id * 40 + s
+  FROM xml_files f, generate_series(1, 40) s;
+
+INSERT INTO download_failures (id, filename, status, ts_created)
+  SELECT id, 'F' || xmlfilename, 'RETRY', now() - (id % 720) * interval '1 hour'
+  FROM xml_files
+  WHERE id % 50 = 0;
+
+ANALYZE xml_files;
+ANALYZE measurements;
+ANALYZE download_failures;
+
+CREATE FUNCTION pg_temp.lookup_timing(label text, lookups integer) RETURNS void
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+  n bigint := (SELECT max(id) FROM xml_files);
+  fname text;
+  t timestamp with time zone;
+  t_xml interval := '0';
+  t_meas interval := '0';
+  t_fail interval := '0';
+  t_view interval;
+BEGIN
+  FOR i IN 1..lookups LOOP
+    SELECT xmlfilename INTO fname FROM xml_files WHERE id = 1 + (i * 7919) % n;
+
+    -- xmlfile_insert: file present, checksum
+    t := clock_timestamp();
+    PERFORM xmldatachksum FROM xml_files WHERE xmlfilename = fname;
+    t_xml := t_xml + (clock_timestamp() - t);
+
+    -- lml_xmlfile_process: measurements of the file (DELETE)
+    t := clock_timestamp();
+    PERFORM count(*) FROM measurements WHERE xmlfilename = fname;
+    t_meas := t_meas + (clock_timestamp() - t);
+
+    -- download_failures_insert, xmlfile_insert: failure present
+    t := clock_timestamp();
+    PERFORM 1 FROM download_failures WHERE filename = 'F' || fname;
+    t_fail := t_fail + (clock_timestamp() - t);
+  END LOOP;
+
+  -- vw_download_failures
+  t := clock_timestamp();
+  PERFORM count(*) FROM download_failures d
+    WHERE NOT EXISTS (SELECT 1 FROM xml_files x WHERE x.xmlfilename = d.filename)
+      AND d.status = 'RETRY';
+  t_view := clock_timestamp() - t;
+
+  RAISE NOTICE '% (% lookups): xml_files % ms, measurements % ms, download_failures % ms, vw_download_failures % ms'
+    , label, lookups
+    , round(extract(epoch FROM t_xml)::numeric * 1000, 1)
+    , round(extract(epoch FROM t_meas)::numeric * 1000, 1)
+    , round(extract(epoch FROM t_fail)::numeric * 1000, 1)
+    , round(extract(epoch FROM t_view)::numeric * 1000, 1);
+END;
+$$;
+
+SELECT pg_temp.lookup_timing('without indexes', :lookups);
+
+CREATE UNIQUE INDEX ON xml_files USING btree (xmlfilename);
+CREATE UNIQUE INDEX ON download_failures USING btree (filename);
+CREATE INDEX ON measurements USING btree (xmlfilename);
+ANALYZE xml_files;
+ANALYZE measurements;
+ANALYZE download_failures;
+
+SELECT pg_temp.lookup_timing('with indexes', :lookups);
@@ -0,0 +1,98 @@
+--
+-- Minimal sos schema for the offline benchmark (lml-benchmark.py)
+--
+-- Only the SOS tables and columns the lml_import functions read and write, no SOS server:
+--   createdb lmlbench
+--   psql -d lmlbench -f benchmark/sos_minimal.sql
+--   psql -d lmlbench -f lml_import.sql
+--   psql -d lmlbench -f lml_import-upgrade.sql
+--   psql -d lmlbench -f lml_import-config-example.dat
+-- Never load this into the database of a real SOS.
+--
+
+\set ON_ERROR_STOP 1
+
+CREATE EXTENSION IF NOT EXISTS postgis;
+
+CREATE SCHEMA sos;
+
+SET search_path = sos, public;
+
+CREATE SEQUENCE observationid_seq;
+
+CREATE TABLE codespace (
+    codespaceid bigserial PRIMARY KEY,
+    codespace character varying(255) NOT NULL UNIQUE
+);
+
+CREATE TABLE unit (
+    unitid bigserial PRIMARY KEY,
+    unit character varying(255) NOT NULL UNIQUE
+);
+
+CREATE TABLE featureofinterest (
+    featureofinterestid bigserial PRIMARY KEY,
+    identifier character varying(255) UNIQUE,
+    name text,
+    geom public.geometry
+);
+
+CREATE TABLE observableproperty (
+    observablepropertyid bigserial PRIMARY KEY,
+    identifier character varying(255) NOT NULL UNIQUE
+);
+
+CREATE TABLE procedure (
+    procedureid bigserial PRIMARY KEY,
+    identifier character varying(255) NOT NULL UNIQUE,
+    deleted character(1) DEFAULT 'F' NOT NULL
+);
+
+CREATE TABLE offering (
+    offeringid bigserial PRIMARY KEY,
+    identifier character varying(255) NOT NULL UNIQUE,
+    name text
+);
+
+CREATE TABLE series (
+    seriesid bigserial PRIMARY KEY,
+    featureofinterestid bigint NOT NULL,
+    observablepropertyid bigint NOT NULL,
+    procedureid bigint NOT NULL,
+    deleted character(1) DEFAULT 'F' NOT NULL,
+    published character(1) DEFAULT 'T' NOT NULL,
+    firsttimestamp timestamp without time zone,
+    lasttimestamp timestamp without time zone,
+    firstnumericvalue numeric(19,2),
+    lastnumericvalue numeric(19,2),
+    unitid bigint,
+    UNIQUE (featureofinterestid, observablepropertyid, procedureid)
+);
+
+CREATE TABLE observation (
+    observationid bigint PRIMARY KEY,
+    seriesid bigint NOT NULL REFERENCES series,
+    phenomenontimestart timestamp without time zone NOT NULL,
+    phenomenontimeend timestamp without time zone NOT NULL,
+    resulttime timestamp without time zone NOT NULL,
+    identifier character varying(255) UNIQUE,
+    codespaceid bigint,
+    deleted character(1) DEFAULT 'F' NOT NULL,
+    unitid bigint,
+    samplinggeometry public.geometry
+);
+
+CREATE INDEX obsseriesidx ON observation USING btree (seriesid);
+
+CREATE TABLE numericvalue (
+    observationid bigint PRIMARY KEY REFERENCES observation,
+    value numeric(19,2)
+);
+
+CREATE TABLE observationhasoffering (
+    observationid bigint NOT NULL REFERENCES observation,
+    offeringid bigint NOT NULL,
+    PRIMARY KEY (observationid, offeringid)
+);
+
+INSERT INTO codespace (codespace) VALUES ('http://www.opengis.net/def/nil/OGC/0/unknown');
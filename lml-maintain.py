@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+#==============================================================================
+#title           :lml-maintain.py
+#description     :Maintenance of the SOS database from the lml_import cache:
+#                 restores the observations of a range of days (original
+#                 identifiers), or republishes them (new identifiers).
+#                 Maintenance of the lml_import tables: monthly partitions
+#                 and retention.
+#version         :1.2
+#usage           :python lml-maintain.py restore [firstday] [lastday]
+#                 OR lml-maintain.py republish [firstday] [lastday]
+#                 [stations] [sensors]
+#                 OR lml-maintain.py partition
+#                 OR lml-maintain.py retention
+#notes           :Works day by day, every day is committed. Restoring the
+#                 same days again is harmless. Run retention e.g. daily.
+#python_version  :2.7.x
+#==============================================================================
+
+# Timestamps ts_* in datatables: transaction time (now()), in order to keep data and logs together.
+# Message log timestamp: real time (clock time)
+
+import sys, time
+import psycopg2
+from datetime import datetime
+from datetime import timedelta
+from sos_config import *
+
+print """Maintain SOS from the LML import cache
+"""
+
+if not ((len(sys.argv) >= 4 and len(sys.argv) <= 6 and sys.argv[1] in ('restore', 'republish')) or
+  (len(sys.argv) == 2 and sys.argv[1] in ('partition', 'retention'))):
+  print """Usage: lml-maintain {help} | {restore|republish firstday lastday [stations] [sensors]} | {partition} | {retention}
+  help:       This help text.
+  restore:    Publishes the cached measurements of firstday up to and
+              including lastday (YYYYMMDD) that are missing in the SOS
+              tables, with their original observation identifiers (e.g.
+              after a rebuild of the SOS database).
+  republish:  Replaces the observations of firstday up to and including
+              lastday with new ones (new observation ids, identifiers from
+              the current uribase).
+  stations:   Optional, comma separated publish station codes (default: all,
+              or *).
+  sensors:    Optional, comma separated sensor codes (default: all).
+  partition:  Converts xml_files, measurements and message_log to tables
+              partitioned by month (once, PostgreSQL 13 or later).
+  retention:  Creates the partitions of the coming months, and removes the
+              data older than lml.retention.<table> months (configuration).
+"""
+  sys.exit()
+
+# Insert error message in database
+def LogMsg(pgcur, operation, filename, msg):
+  msglevel = msg[:msg.find(":")]
+  sql = "INSERT INTO message_log(msgtimestamp, operation, filename, msglevel, msg, ts_created) values (clock_timestamp(), %s, %s, %s, %s, now());"
+  pgcur.execute(sql, (operation, filename, msglevel, msg[msg.find(":") + 1:]))
+
+# Comma separated codes from the commandline (None: all)
+def GetCodes(arg):
+  if arg == None or arg == '*':
+    return None
+  return [code.strip() for code in arg.split(',') if code.strip() != '']
+
+# Restore or republish the observations of one day (set based, restore_sos)
+def RestoreDay(pgcur, day, stations, sensors, newids):
+  sql = "SELECT restore_sos(%s, %s, %s, %s, %s);"
+  pgcur.execute(sql, (day.strftime("%Y-%m-%d"), (day + timedelta(days=1)).strftime("%Y-%m-%d"), stations, sensors, newids))
+  return pgcur.fetchone()[0]
+
+# Update the series table with min/max values
+def UpdateSeries(pgcur):
+  sql = "SELECT updateseries FROM updateseries();"
+  pgcur.execute(sql)
+  return pgcur.fetchone()[0]
+
+# Convert the tables to monthly partitions (partition_tables)
+def PartitionTables(pgcur):
+  sql = "SELECT partition_tables();"
+  pgcur.execute(sql)
+  return [r[0] for r in pgcur.fetchall()]
+
+# Drop or delete the expired data (apply_retention)
+def ApplyRetention(pgcur):
+  sql = "SELECT relation, action, rows_removed FROM apply_retention();"
+  pgcur.execute(sql)
+  return pgcur.fetchall()
+
+# Open global database connection
+conn_string = "host='"+DBHOST+"' port='"+DBPORT+"' dbname='"+DATABASE+"' user='"+DBUSER+"' password='" + DBPWD + "'"
+print "Connecting to database..."
+conn = psycopg2.connect(conn_string)
+cursor = conn.cursor()
+cursor.execute("SET search_path = " + SCHEMA + ",public;")
+conn.commit()
+print "Connected!\n"
+
+command = sys.argv[1]
+
+if command == 'partition':
+  try:
+    tables = PartitionTables(cursor)
+    LogMsg(cursor, "Maintenance", "*", "INFO:Partitioned " + str(len(tables)) + " tables.")
+    conn.commit()
+  except psycopg2.Error as e:
+    conn.rollback()
+    print "Error: " + str(e).strip()
+    conn.close()
+    sys.exit(1)
+  for table in tables:
+    print "Partitioned: " + table
+  if len(tables) == 0:
+    print "Nothing to partition."
+  conn.close()
+  sys.exit()
+
+if command == 'retention':
+  start = time.time()
+  result = ApplyRetention(cursor)
+  removed = 0
+  for r in result:
+    if r[1] == 'dropped':
+      print "Dropped: " + r[0]
+    else:
+      print "Deleted: " + str(r[2]) + " rows from " + r[0]
+      removed += r[2]
+  LogMsg(cursor, "Maintenance", "*", "INFO:Retention, " + str(len([r for r in result if r[1] == 'dropped'])) + " partitions dropped, " + str(removed) + " rows deleted.")
+  conn.commit()
+  print "Retention applied in " + str(round(time.time() - start, 1)) + " s"
+  conn.close()
+  sys.exit()
+
+firstday = datetime.strptime(sys.argv[2], "%Y%m%d")
+lastday = datetime.strptime(sys.argv[3], "%Y%m%d")
+stations = GetCodes(sys.argv[4] if len(sys.argv) > 4 else None)
+sensors = GetCodes(sys.argv[5] if len(sys.argv) > 5 else None)
+
+LogMsg(cursor, "SOSRestore", "*", "INFO:Start of " + command + " " + firstday.strftime("%Y%m%d") + "-" + lastday.strftime("%Y%m%d") + ".")
+conn.commit()
+start = time.time()
+total = 0
+day = firstday
+while day <= lastday:
+  daystart = time.time()
+  try:
+    observations = RestoreDay(cursor, day, stations, sensors, command == 'republish')
+    conn.commit()
+  except psycopg2.Error as e:
+    conn.rollback()
+    cursor.execute("SET search_path = " + SCHEMA + ",public;")
+    LogMsg(cursor, "SOSRestore", "*", "ERROR:" + command + " " + day.strftime("%Y%m%d") + ": " + str(e).strip())
+    conn.commit()
+    print "Error: " + day.strftime("%Y%m%d") + ": " + str(e).strip()
+    break
+  seconds = time.time() - daystart
+  total += observations
+  print day.strftime("%Y%m%d") + ": " + str(observations) + " observations in " + str(round(seconds, 1)) + " s (" + str(int(observations / max(seconds, 0.001))) + "/s)"
+  day += timedelta(days=1)
+
+seconds = time.time() - start
+print "Published " + str(total) + " observations in " + str(round(seconds, 1)) + " s (" + str(int(total / max(seconds, 0.001))) + "/s)"
+LogMsg(cursor, "SOSRestore", "*", "INFO:End of " + command + " (" + str(total) + " observations).")
+
+# Finally, udpate the series table
+if UpdateSeries(cursor):
+  print "Updated metadata successfully."
+
+conn.commit()
+conn.close()
+# The end
@@ -9,14 +9,16 @@
 #author          :Wouter Boasson
 #date            :20140731
 #version         :1.1
-#usage           :python lml-prepare.py
+#usage           :python lml-prepare.py OR lml-prepare.py reconcile
+#                 (--profile: also report database timings per statement)
 #notes           :Running the script is pretty harmless, the SOS server with
 #                 database constraints prevent duplicates in the database.
 #python_version  :2.7.x
 #==============================================================================
 
-import os, sys, time
+import os, sys, time, hashlib
 import urllib, urllib2, socket
+import threading, Queue
 import json
 import uuid
 import psycopg2, psycopg2.extras
@@ -24,11 +26,29 @@ from datetime import datetime
 from datetime import timedelta
 import xml.etree.ElementTree as ET
 from sos_config import *
+from lml_metrics import RunMetrics
 
 print """Prepare SOS-service for LML-data.
 (c) Wouter Boasson, 2014
 """
 
+PROFILE = '--profile' in sys.argv
+if PROFILE:
+  sys.argv.remove('--profile')
+
+if len(sys.argv) == 2 and sys.argv[1] == 'help':
+  print """Usage: lml-prepare {help} | {reconcile} {--profile}
+  No options: Sends sensor, resulttemplate and a temporary observation for all
+              configured station/sensor combinations.
+  help:       This help text.
+  reconcile:  Only sends what is missing or changed: compares the identifiers
+              in the SOS database with the configuration, and the SensorML
+              with the fingerprint of the last pushed SensorML.
+  --profile:  Also reports the database time per statement.
+"""
+  sys.exit()
+RECONCILE = len(sys.argv) == 2 and sys.argv[1] == 'reconcile'
+
 VERBOSE = False
 DRYRUN = False
 #VERBOSE = True
@@ -42,6 +62,7 @@ DRYRUN = False
 #AUTHTOKEN = "Your auth token"
 #HTTPTIMEOUT = 5 (in seconds)
 #RETRYWAIT = 0.05 (in seconds)
+#PREPAREWORKERS = 4 (number of concurrent SOS-T requests)
 
 now = datetime.now()
 
@@ -51,6 +72,32 @@ def GetConfigFromDb(pgcur, key):
   pgcur.execute(sql, (key, ))
   return pgcur.fetchone()[0]
 
+# Read optional configuration keys from database
+# (returns the default when the key is not present or null)
+def GetConfigFromDbDefault(pgcur, key, default):
+  sql = "SELECT configvalue FROM configuration WHERE key = %s;"
+  pgcur.execute(sql, (key, ))
+  result = pgcur.fetchone()
+  if result == None or result[0] == None:
+    return default
+  return result[0]
+
+metrics = RunMetrics('lml-prepare')
+STARTTIME = time.time()
+
+# Cursor that keeps the database time per statement (--profile)
+statements = {}
+
+class ProfileCursor(psycopg2.extras.DictCursor):
+  def execute(self, sql, args=None):
+    start = time.time()
+    try:
+      return super(ProfileCursor, self).execute(sql, args)
+    finally:
+      key = " ".join(sql.split())[:80]
+      calls, total = statements.get(key, (0, 0.0))
+      statements[key] = (calls + 1, total + time.time() - start)
+
 # Http GET request to the SOS KVP service endpoint
 # (needed to delete temporary observations)
 def HttpGet(myrequest):
@@ -58,6 +105,7 @@ def HttpGet(myrequest):
   socket.timeout(HTTPTIMEOUT)
   headers = {"Authorization": AUTHTOKEN}
   req = urllib2.Request(SOSSERVER + fullpath, None, headers)
+  start = time.time()
   try:
     response = urllib2.urlopen(req)
   except urllib2.HTTPError as e:
@@ -73,6 +121,8 @@ def HttpGet(myrequest):
     return "ERROR:CONNECTION " + str(e) + " " + SOSSERVER + fullpath
   else:
     result = response.read()
+    metrics.sample('http.latency', time.time() - start, 's')
+    metrics.add('http.bytes', len(result), 'B')
     return result
 
 # POST request to the SOS JSON service
@@ -82,11 +132,14 @@ def HttpPostData(postdata):
   try:
     headers = {"Content-type": "application/json", "Accept": "application/json", "Authorization": AUTHTOKEN}
     req = urllib2.Request(SOSSERVER + SOSJSON, postdata, headers)
+    start = time.time()
     response = urllib2.urlopen(req)
-    return response.read()
+    result = response.read()
+    metrics.sample('http.latency', time.time() - start, 's')
+    metrics.add('http.bytes', len(result), 'B')
+    return result
   except urllib2.HTTPError as e:
-    print '  error: ' + str(e.code)
-    return "ERROR:HTTP " + str(e.code)
+    return "ERROR:HTTP " + str(e.code) + " " + e.read()
 
 # Insert error message in database
 # (logging)
@@ -95,21 +148,145 @@ def LogMsg(pgcur, operation, filename, msg):
   sql = "INSERT INTO message_log(msgtimestamp, operation, filename, msglevel, msg, ts_created) values (clock_timestamp(), %s, %s, %s, %s, now());"
   pgcur.execute(sql, (operation, filename, msglevel, msg[msg.find(":") + 1:]))
 
-# Get a template
+# Get all templates of a type
 # (templates for sensor, resulttemplate and featureofinterest and observation are
-# stored in the database)
-def GetTemplate(pgcur, tpltype, template):
-  sql = "SELECT contents FROM templates WHERE templatetype = %s AND templatename = %s"
-  pgcur.execute(sql, (tpltype, template))
-  return str(pgcur.fetchone()[0]).replace("\r", "\n") # just in case, when created on a mac
+# stored in the database; read once, returns a dictionary name => contents)
+def GetTemplates(pgcur, tpltype):
+  sql = "SELECT templatename, contents FROM templates WHERE templatetype = %s"
+  pgcur.execute(sql, (tpltype, ))
+  templates = {}
+  for r in pgcur.fetchall():
+    templates[r[0]] = str(r[1]).replace("\r", "\n") # just in case, when created on a mac
+  return templates
 
-# Get the SensorML (produced by a database function)
+# Get the SensorML of all station/sensor combinations to publish (produced by a database function)
 # (SensorMl is also constructed from a template, but that's done in the database, easier
-# because a lot of data have to be pulled together)
-def GetSensorMl(pgcur, template, publishstatcode, component, inputname, outputname):
-  sql = "select process_sensor_tpl from " + SCHEMA + ".process_sensor_tpl(%s, %s, %s, %s, %s);"
-  pgcur.execute(sql, (template, publishstatcode, component, inputname, outputname))
-  return str(pgcur.fetchone()[0]).replace("\r", "\n") # just in case, when created on a mac
+# because a lot of data have to be pulled together; one call for all sensors)
+def GetSensorMlAll(pgcur, template, inputname):
+  sql = "select * from " + SCHEMA + ".process_sensor_tpl_all(%s, %s);"
+  pgcur.execute(sql, (template, inputname))
+  return pgcur.fetchall()
+
+# Get the identifiers present in the SOS database (reconcile mode)
+# (returns a dictionary with a set of identifiers per table)
+def GetSosIdentifiers(pgcur):
+  present = {}
+  for key, sql in [('procedure', "SELECT identifier FROM sos.procedure;")
+      , ('featureofinterest', "SELECT identifier FROM sos.featureofinterest;")
+      , ('offering', "SELECT identifier FROM sos.offering;")
+      , ('unit', "SELECT unit FROM sos.unit;")]:
+    pgcur.execute(sql)
+    present[key] = set([r[0] for r in pgcur.fetchall()])
+  # series by (featureofinterest, observableproperty, procedure)
+  sql = """SELECT f.identifier, o.identifier, p.identifier
+    FROM sos.series s
+    JOIN sos.featureofinterest f ON f.featureofinterestid = s.featureofinterestid
+    JOIN sos.observableproperty o ON o.observablepropertyid = s.observablepropertyid
+    JOIN sos.procedure p ON p.procedureid = s.procedureid;"""
+  pgcur.execute(sql)
+  present['series'] = set([(r[0], r[1], r[2]) for r in pgcur.fetchall()])
+  return present
+
+# Get the fingerprints (md5 of the SensorML) of the sensors last pushed to the SOS
+def GetFingerprints(pgcur):
+  sql = "SELECT procedure_identifier, sensorml_md5 FROM sensor_fingerprints;"
+  pgcur.execute(sql)
+  return dict([(r[0], r[1]) for r in pgcur.fetchall()])
+
+# Store the fingerprints of the pushed sensors (list of (procedure identifier, md5))
+def StoreFingerprints(pgcur, fingerprints):
+  if len(fingerprints) == 0:
+    return
+  sql = "INSERT INTO " + SCHEMA + """.sensor_fingerprints (procedure_identifier, sensorml_md5, ts_pushed)
+    SELECT DISTINCT ON (procedure_identifier) procedure_identifier, sensorml_md5, now()
+    FROM unnest(%s::text[], %s::text[]) AS u(procedure_identifier, sensorml_md5)
+    ON CONFLICT (procedure_identifier) DO UPDATE SET sensorml_md5 = EXCLUDED.sensorml_md5, ts_pushed = EXCLUDED.ts_pushed;"""
+  pgcur.execute(sql, ([f[0] for f in fingerprints], [f[1] for f in fingerprints]))
+
+# Mark the series of the temporary observations dirty (updateseries recomputes them:
+# the SOS moved their first timestamp to the temporary observation)
+def MarkSeriesDirty(pgcur, observationids):
+  if len(observationids) == 0:
+    return
+  sql = "INSERT INTO " + SCHEMA + """.series_dirty (seriesid, mintime, removed, ts_created)
+    SELECT seriesid, min(phenomenontimeend), true, now()
+    FROM sos.observation
+    WHERE identifier = ANY(%s)
+    GROUP BY seriesid;"""
+  pgcur.execute(sql, (observationids, ))
+
+# Read the values used in the SOS-T requests from the SensorML
+# (one parse per document, every expression evaluated once)
+def ReadSensorMl(sensorml):
+  root = ET.fromstring(sensorml)
+  values = {}
+  for key, path, attrib in SMLPATHS:
+    elem = root.find(path, nsp)
+    if attrib == None:
+      values[key] = elem.text
+    else:
+      values[key] = elem.attrib[attrib]
+  return values
+
+# Result of a SOS-T request: ('inserted'|'present'|'failed', message)
+# (key: the identifier in the response to show, None for the sensor id)
+def PostResult(response, key, sensorid):
+  try:
+    j = json.loads(response)
+    if key == None:
+      return ('inserted', j['request'] + ' ' + sensorid)
+    return ('inserted', j['request'] + ' ' + j[key])
+  except:
+    if 'already' in response.lower():
+      return ('present', 'already present')
+    return ('failed', 'error ' + response[:200])
+
+# Submit the SOS-T requests of one sensor, in order (sensor before template before observation)
+# (requests: list of (request name, json, response key), returns list of (request name, result, message))
+def SubmitRequests(sensorid, requests):
+  results = []
+  for request, postdata, key in requests:
+    try:
+      status, msg = PostResult(HttpPostData(postdata), key, sensorid)
+    except Exception as e:
+      status, msg = ('failed', 'error ' + str(e))
+    results.append((request, status, msg))
+  return results
+
+# Submit the SOS-T requests of the sensors of one station, one sensor after the other
+# (their temporary observations insert the same featureofinterest, sent at the same
+# time they fail on its unique key; returns list of (job, results))
+def SubmitStation(stationjobs):
+  return [(job, SubmitRequests(job['sensorid'], job['requests'])) for job in stationjobs]
+
+# Run jobs concurrently in a pool of PREPAREWORKERS threads
+# (generator, yields (job, result) in order of completion; http only, no database access)
+def RunConcurrent(function, jobs):
+  todo = Queue.Queue()
+  done = Queue.Queue()
+  for job in jobs:
+    todo.put(job)
+  def Worker():
+    while True:
+      try:
+        job = todo.get_nowait()
+      except Queue.Empty:
+        return
+      try:
+        result = function(job)
+      except Exception as e:
+        result = "ERROR:" + str(e)
+      done.put((job, result))
+  workers = []
+  for i in range(min(PREPAREWORKERS, len(jobs))):
+    t = threading.Thread(target=Worker)
+    t.daemon = True
+    t.start()
+    workers.append(t)
+  for i in range(len(jobs)):
+    yield done.get()
+  for t in workers:
+    t.join()
 
 # ###################################################################################################################
 # 'Main'
@@ -117,7 +294,10 @@ def GetSensorMl(pgcur, template, publishstatcode, component, inputname, outputna
 conn_string = "host='"+DBHOST+"' port='"+DBPORT+"' dbname='"+DATABASE+"' user='"+DBUSER+"' password='" + DBPWD + "'"
 print "Connecting to database..."
 conn = psycopg2.connect(conn_string)
-cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+if PROFILE:
+  cursor = conn.cursor(cursor_factory=ProfileCursor)
+else:
+  cursor = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 cursor.execute("SET search_path = " + SCHEMA + ",public;")
 print "Connected!\n"
 
@@ -128,65 +308,79 @@ SOSKVP = GetConfigFromDb(cursor, 'sos.server.api.kvp')
 AUTHTOKEN = GetConfigFromDb(cursor, 'sos.server.authtoken')
 HTTPTIMEOUT = float(GetConfigFromDb(cursor, 'http.timeout'))
 RETRYWAIT = float(GetConfigFromDb(cursor, 'http.retrywait'))
+PREPAREWORKERS = max(1, int(GetConfigFromDbDefault(cursor, 'sos.prepare.workers', 1)))
 
 # Set XML namespaces
 nsp = {'sml': 'http://www.opengis.net/sensorML/1.0.1'
   , 'swe': 'http://www.opengis.net/swe/1.0.1'}
 
-# Loop through the active and to publish sensors
-sql = "SELECT * FROM vw_statsensunit WHERE publish_sos = true AND activityend is null;"
-cursor.execute(sql)
-result = cursor.fetchall()
-tempIds = [] # list of temporary ids that need to be removed (observations are created to get the units inserted)
+# Values read from the SensorML: (name, path, attribute or None for the text)
+SMLPATHS = [
+  # ObservableProperty read from the SensorML (so they always match :-) )
+  ('observableproperty', ".//sml:outputs/sml:OutputList/sml:output/swe:Category", 'definition')
+  # Offering
+  , ('offering', ".//*[@definition='urn:ogc:def:identifier:OGC:offeringID']/swe:value", None)
+  , ('sensorid', ".//*[@definition='urn:ogc:def:identifier:OGC:1.0:uniqueID']/sml:value", None)
+  # FeatureOfInterest
+  , ('foiId', ".//*/sml:capabilities[@name='featuresOfInterest']/swe:SimpleDataRecord/swe:field[@name='featureOfInterestID']/swe:Text/swe:value", None)
+  , ('foiSampledfeat', ".//sml:inputs/sml:InputList/sml:input/swe:ObservableProperty", 'definition')
+  # X, Y, Z
+  , ('posY', ".//*/sml:position[@name='sensorPosition']/swe:Position/swe:location/swe:Vector/swe:coordinate[@name='northing']/swe:Quantity/swe:value", None)
+  , ('posX', ".//*/sml:position[@name='sensorPosition']/swe:Position/swe:location/swe:Vector/swe:coordinate[@name='easting']/swe:Quantity/swe:value", None)
+  , ('posZ', ".//*/sml:position[@name='sensorPosition']/swe:Position/swe:location/swe:Vector/swe:coordinate[@name='altitude']/swe:Quantity/swe:value", None)
+]
+
+# Templates, once
+templates = GetTemplates(cursor, "JSON")
+
+# Reconcile: what is in the SOS already
+if RECONCILE:
+  present = GetSosIdentifiers(cursor)
+  fingerprints = GetFingerprints(cursor)
+  if not 'UpdateSensorDescription' in templates:
+    print 'Warning: template UpdateSensorDescription not found, changed sensors will not be updated'
+
+# Loop through the active and to publish sensors (SensorML of all sensors in one call)
+metrics.start('sensorml')
+result = GetSensorMlAll(cursor, 'SensorML.basic', 'air')
+jobs = []
+stations = [] # features of interest, in order
+stationjobs = {} # featureofinterest => jobs of its sensors
+uptodate = 0
 print 'Creating sensors and features of interest (by inserting temporary observations)'
-c = 0
 for r in result:
-  print r['publishstationcode'] + ' (' + r['name'] + '): ' + r['sensorcode']
-  # Get the SensorML, and initiate XML parser
-  sensorml = GetSensorMl(cursor, 'SensorML.basic', r['publishstationcode'], r['sensorcode'], 'air', r['sensorcode'] + '_value')
+  sensorml = str(r['sensorml']).replace("\r", "\n") # just in case, when created on a mac
+  # Initiate XML parser, read the values
   try:
-    root = ET.fromstring(sensorml)
+    v = ReadSensorMl(sensorml)
   except:
     print sensorml
     sys.exit()
-
-  # ObservableProperty read from the SensorML (so they always match :-) )
-  observableproperty = root.findall(".//sml:outputs/sml:OutputList/sml:output/swe:Category", nsp)[0].attrib['definition'] 
-
-  # Offering
-  offering = root.findall(".//*[@definition='urn:ogc:def:identifier:OGC:offeringID']/swe:value", nsp)[0].text
-  sensorid = root.findall(".//*[@definition='urn:ogc:def:identifier:OGC:1.0:uniqueID']/sml:value", nsp)[0].text 
-
-  # FeatureOfInterest
-  foiId = root.findall(".//*/sml:capabilities[@name='featuresOfInterest']/swe:SimpleDataRecord/swe:field[@name='featureOfInterestID']/swe:Text/swe:value", nsp)[0].text
+  observableproperty = v['observableproperty']
+  offering = v['offering']
+  sensorid = v['sensorid']
+  foiId = v['foiId']
   foiName = r["name"]
   if r["municipality"] != '':
     foiName = foiName + ", " + r['municipality']
-  foiSampledfeat = root.findall(".//sml:inputs/sml:InputList/sml:input/swe:ObservableProperty", nsp)[0].attrib['definition']
-  # X, Y, Z
-  posY = root.findall(".//*/sml:position[@name='sensorPosition']/swe:Position/swe:location/swe:Vector/swe:coordinate[@name='northing']/swe:Quantity/swe:value", nsp)[0].text
-  posX = root.findall(".//*/sml:position[@name='sensorPosition']/swe:Position/swe:location/swe:Vector/swe:coordinate[@name='easting']/swe:Quantity/swe:value", nsp)[0].text
-  posZ = root.findall(".//*/sml:position[@name='sensorPosition']/swe:Position/swe:location/swe:Vector/swe:coordinate[@name='altitude']/swe:Quantity/swe:value", nsp)[0].text
+  foiSampledfeat = v['foiSampledfeat']
+  posY = v['posY']
+  posX = v['posX']
+  posZ = v['posZ']
 
   # Observation
   unit = r["m_unit"] # from unit table, everything else can be default, will be thrown away
 
   # Process the insertsensor template
-  insertsensor = GetTemplate(cursor, "JSON", "InsertSensor.SamplingPoint.Measurement")
+  insertsensor = templates["InsertSensor.SamplingPoint.Measurement"]
   insertsensor = insertsensor.replace("$procedure.sensorml$", sensorml.replace("\"","\\\""))
   insertsensor = insertsensor.replace("$sensor.observableproperty.output.id$", observableproperty)
   insertsensor = insertsensor.replace("\r","").replace("\n","")
   if VERBOSE:
     print insertsensor
-  if not DRYRUN:
-    j = HttpPostData(insertsensor)
-    try:
-      print '  => ' + json.loads(j)['request'] + ' ' + json.loads(j)['assignedProcedure']
-    except:
-      print '  => error, probably already present'
 
   # Process the insertresulttemplate template
-  insertresulttpl = GetTemplate(cursor, "JSON", "InsertResultTemplate")
+  insertresulttpl = templates["InsertResultTemplate"]
   insertresulttpl = insertresulttpl.replace('$sensor.id$', sensorid)
   insertresulttpl = insertresulttpl.replace('$sensor.resulttemplate.id$', sensorid + '/template/basic')
   insertresulttpl = insertresulttpl.replace('$sensor.offering$', offering)
@@ -201,17 +395,10 @@ for r in result:
   insertresulttpl = insertresulttpl.replace("$observation.unit$", unit)
   if VERBOSE:
     print insertresulttpl
-  if not DRYRUN:
-    j = HttpPostData(insertresulttpl)
-    try: 
-      print '  => ' + json.loads(j)['request'] + ' ' + json.loads(j)['acceptedTemplate'] 
-    except:
-      print '  => error, probably already present'
-  
+
   # Process the insertobservation template
-  tempid = sensorid + '/' + str(uuid.uuid4())
-  tempIds.append(tempid)
-  insertobservation = GetTemplate(cursor, 'JSON', 'InsertObservation')
+  tempid = sensorid + '/' + str(uuid.uuid4()) # temporary id, removed afterwards (observations are created to get the units inserted)
+  insertobservation = templates['InsertObservation']
   insertobservation = insertobservation.replace("$sensor.offering.id$", offering)
   insertobservation = insertobservation.replace("$sensor.observation.id$", tempid)
   insertobservation = insertobservation.replace("$sensor.id$", sensorid)
@@ -228,34 +415,120 @@ for r in result:
   insertobservation = insertobservation.replace("$observation.value$", "0")
   if VERBOSE:
     print insertobservation
-  if not DRYRUN:
-    j = HttpPostData(insertobservation)
-    try: 
-      print '  => ' + json.loads(j)['request'] + ' ' + sensorid
-    except:
-      print '  => error, probably already present'
-
-  c += 1
-
-print "Deleting temporary observations (" + str(c) + ")"
-n = 0
-for t in tempIds:
-  deleterequest = "service=SOS&version=2.0.0&request=DeleteObservation&observation=" + urllib.quote_plus(t)
-  if not DRYRUN:
-    HttpGet(deleterequest)
-  if VERBOSE:
+
+  requests = [("InsertSensor", insertsensor, 'assignedProcedure')
+    , ("InsertResultTemplate", insertresulttpl, 'acceptedTemplate')
+    , ("InsertObservation", insertobservation, None)]
+  fingerprint = hashlib.md5(sensorml).hexdigest()
+
+  # Reconcile: a new sensor (or offering) gets all requests, a known sensor only what is
+  # missing or changed (the temporary observation inserts featureofinterest, unit and series)
+  if RECONCILE and sensorid in present['procedure'] and offering in present['offering']:
+    requests = []
+    if fingerprints.get(sensorid) != fingerprint and 'UpdateSensorDescription' in templates:
+      updatesensor = templates["UpdateSensorDescription"]
+      updatesensor = updatesensor.replace("$sensor.id$", sensorid)
+      updatesensor = updatesensor.replace("$procedure.sensorml$", sensorml.replace("\"","\\\""))
+      updatesensor = updatesensor.replace("\r","").replace("\n","")
+      if VERBOSE:
+        print updatesensor
+      requests.append(("UpdateSensorDescription", updatesensor, 'procedure'))
+    if not foiId in present['featureofinterest'] or not unit in present['unit'] \
+        or not (foiId, observableproperty, sensorid) in present['series']:
+      requests.append(("InsertObservation", insertobservation, None))
+    if len(requests) == 0:
+      uptodate += 1
+      continue
+
+  jobs.append({'label': r['publishstationcode'] + ' (' + r['name'] + '): ' + r['sensorcode']
+    , 'sensorid': sensorid, 'requests': requests, 'tempid': tempid, 'fingerprint': fingerprint})
+  if not foiId in stationjobs:
+    stationjobs[foiId] = []
+    stations.append(foiId)
+  stationjobs[foiId].append(jobs[-1])
+
+metrics.stop('sensorml')
+
+# Submit the requests, PREPAREWORKERS stations (features of interest) at a time
+metrics.start('submit')
+summary = {}
+for request in ["InsertSensor", "UpdateSensorDescription", "InsertResultTemplate", "InsertObservation", "DeleteObservation"]:
+  summary[request] = {'inserted': 0, 'present': 0, 'failed': 0}
+deleteIds = []
+pushed = [] # (sensor, fingerprint) of the SensorML accepted by the SOS
+if not DRYRUN:
+  for sensorjobs, stationresults in RunConcurrent(SubmitStation, [stationjobs[foi] for foi in stations]):
+    if isinstance(stationresults, str):
+      stationresults = [(job, [(request, 'failed', stationresults) for request, postdata, key in job['requests']]) for job in sensorjobs]
+    for job, results in stationresults:
+      print job['label']
+      for request, status, msg in results:
+        print '  => ' + request + ': ' + msg
+        summary[request][status] += 1
+        if request == "InsertObservation" and status == 'inserted':
+          deleteIds.append(job['tempid'])
+        if request in ["InsertSensor", "UpdateSensorDescription"] and status == 'inserted':
+          pushed.append((job['sensorid'], job['fingerprint']))
+else:
+  deleteIds = [job['tempid'] for job in jobs if "InsertObservation" in [q[0] for q in job['requests']]]
+metrics.stop('submit')
+
+print "Deleting temporary observations (" + str(len(deleteIds)) + ")"
+deleterequests = ["service=SOS&version=2.0.0&request=DeleteObservation&observation=" + urllib.quote_plus(t) for t in deleteIds]
+if VERBOSE:
+  for deleterequest in deleterequests:
     print deleterequest
-  if n >= 5:
-    sys.stderr.write(".")
-    n = 0
-  n += 1
+metrics.start('delete')
+if not DRYRUN:
+  for deleterequest, response in RunConcurrent(HttpGet, deleterequests):
+    if response[0:6] == "ERROR:":
+      summary["DeleteObservation"]['failed'] += 1
+    else:
+      summary["DeleteObservation"]['inserted'] += 1
+metrics.stop('delete')
 
 print "Done."
 print ""
+print "Summary (" + str(len(jobs) + uptodate) + " sensors):"
+for request in ["InsertSensor", "InsertResultTemplate", "InsertObservation"]:
+  print "  " + request + ": " + str(summary[request]['inserted']) + " inserted, " + str(summary[request]['present']) + " already present, " + str(summary[request]['failed']) + " failed"
+print "  DeleteObservation: " + str(summary["DeleteObservation"]['inserted']) + " deleted, " + str(summary["DeleteObservation"]['failed']) + " failed"
+if RECONCILE:
+  print "  UpdateSensorDescription: " + str(summary["UpdateSensorDescription"]['inserted']) + " updated, " + str(summary["UpdateSensorDescription"]['failed']) + " failed"
+  print "  Up to date: " + str(uptodate)
+print ""
 print "Note: in order to fully remove the temporary observations, clean up"
 print "'Deleted observations' using the SOS Admin interface."
 
 conn.rollback() # Whatever happened, we do not want to write to the database.
+
+# The SOS knows the series and offerings now: cache their ids for publishing,
+# keep the fingerprints of the pushed SensorML (reconcile), and have the series
+# metadata recomputed without the temporary observations
+if not DRYRUN:
+  metrics.start('publishtargets')
+  StoreFingerprints(cursor, pushed)
+  MarkSeriesDirty(cursor, deleteIds)
+  cursor.execute("SELECT " + SCHEMA + ".refresh_publish_targets();")
+  print "Refreshed publish targets (" + str(cursor.fetchone()[0]) + ")"
+  metrics.stop('publishtargets')
+  conn.commit()
+
+  # Metrics of the run, in one batch
+  for request in summary:
+    for status in summary[request]:
+      metrics.add('requests.' + request + '.' + status, summary[request][status])
+  metrics.add('sensors.uptodate', uptodate)
+  metrics.add('phase.total', time.time() - STARTTIME, 's')
+  if PROFILE:
+    print ""
+    print "Database time per statement:"
+    for key, (calls, total) in sorted(statements.items(), key=lambda s: -s[1][1]):
+      print "  %8.3f s %7d x  %s" % (total, calls, key)
+      metrics.add('statement.' + key, total, 's')
+  metrics.store(cursor)
+  conn.commit()
+  print "Metrics stored (run " + metrics.runid + ")"
 conn.close()
 # The end
 
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+#==============================================================================
+#title           :lml-process.py
+#description     :Processes the xml files stored by lml-retrieve.py, when
+#                 processing is deferred (configuration key
+#                 lml.process.deferred = T). Runs a number of workers, each
+#                 with its own database session.
+#version         :1.1
+#usage           :python lml-process.py OR lml-process.py [workers] [batchsize]
+#notes           :Files are claimed with FOR UPDATE SKIP LOCKED, running
+#                 several instances at the same time is harmless.
+#python_version  :2.7.x
+#==============================================================================
+
+# Timestamps ts_* in datatables: transaction time (now()), in order to keep data and logs together.
+# Message log timestamp: real time (clock time)
+
+import sys, time, random
+import threading, Queue
+import psycopg2
+from sos_config import *
+from lml_metrics import RunMetrics
+
+print """Process LML xml files for SOS
+"""
+
+if len(sys.argv) == 2  and sys.argv[1] == 'help':
+  print """Usage: lml-process {help} | {[workers] [batchsize]}
+  No options: Uses defaults from database
+  help:       This help text.
+  workers:    Number of workers (database sessions) processing files at the
+              same time. Must be combined with batchsize.
+  batchsize:  Number of files processed (and committed) at once by a worker.
+              Must be combined with workers.
+"""
+  sys.exit()
+
+# Global variables with examples.
+# The actual configuration is in the database (table: <schema>.configuration).
+#PROCESSWORKERS = 4 (number of workers)
+#BATCHSIZE = 10 (files per transaction)
+
+# Read optional configuration keys from database
+# (returns the default when the key is not present or null)
+def GetConfigFromDbDefault(pgcur, key, default):
+  sql = "SELECT configvalue FROM configuration WHERE key = %s;"
+  pgcur.execute(sql, (key, ))
+  result = pgcur.fetchone()
+  if result == None or result[0] == None:
+    return default
+  return result[0]
+
+# Insert error message in database
+def LogMsg(pgcur, operation, filename, msg):
+  msglevel = msg[:msg.find(":")]
+  sql = "INSERT INTO message_log(msgtimestamp, operation, filename, msglevel, msg, ts_created) values (clock_timestamp(), %s, %s, %s, %s, now());"
+  pgcur.execute(sql, (operation, filename, msglevel, msg[msg.find(":") + 1:]))
+
+metrics = RunMetrics('lml-process')
+STARTTIME = time.time()
+
+# Counters of the current transaction: observations published and unpublished (sos
+# tables); a batch counts the differences with the start of its transaction, as since
+# PostgreSQL 15 the xact statistics also hold the not yet reported counts of earlier
+# transactions of the session
+def ReadCounters(pgcur):
+  sql = """SELECT coalesce(sum(n_tup_ins) FILTER (WHERE relname = 'numericvalue'), 0)
+      , coalesce(sum(n_tup_upd) FILTER (WHERE relname = 'observation'), 0)
+    FROM pg_stat_xact_user_tables
+    WHERE schemaname = 'sos';"""
+  pgcur.execute(sql)
+  return pgcur.fetchone()
+
+# Open a database connection (one per worker)
+def Connect():
+  pgconn = psycopg2.connect(conn_string)
+  pgcur = pgconn.cursor()
+  pgcur.execute("SET search_path = " + SCHEMA + ",public;")
+  pgconn.commit()
+  return pgconn, pgcur
+
+# Worker: claims and processes batches of files until there are none left, commits
+# every batch (puts the number of processed files, and its error messages, in 'results';
+# errors of single files are logged by process_xml_files, the worker only stops after
+# MAXERRORS failed batches in a row; a deadlock or serialization failure is retried
+# up to MAXRETRIES times, after RETRYWAIT seconds doubled with every retry, and then
+# counts as a failed batch)
+MAXERRORS = 3
+MAXRETRIES = 5
+RETRYWAIT = 0.1
+
+def ProcessWorker(batchsize, results):
+  pgconn, pgcur = Connect()
+  n = 0
+  errors = 0
+  retries = 0
+  while True:
+    try:
+      start = time.time()
+      before = ReadCounters(pgcur)
+      pgcur.execute("SELECT process_xml_files(%s);", (batchsize, ))
+      processed = pgcur.fetchone()[0]
+      after = ReadCounters(pgcur)
+      pgconn.commit()
+      errors = 0
+      retries = 0
+    except psycopg2.Error as e:
+      pgconn.rollback()
+      if isinstance(e, psycopg2.extensions.TransactionRollbackError) and retries < MAXRETRIES:
+        # conflict with another worker, try again (random wait: workers in lockstep get out of step)
+        retries += 1
+        metrics.add('batches.retried', 1)
+        time.sleep(RETRYWAIT * 2 ** retries * random.uniform(0.5, 1.5))
+        continue
+      retries = 0
+      metrics.add('batches.failed', 1)
+      LogMsg(pgcur, "XMLProcess", "*", "ERROR:" + str(e).strip())
+      pgconn.commit()
+      results.put("ERROR:" + str(e).strip())
+      errors += 1
+      if errors < MAXERRORS:
+        continue
+      results.put(n)
+      break
+    if processed == 0:
+      results.put(n)
+      break
+    n += processed
+    metrics.add('files.processed', processed)
+    metrics.add('observations.published', after[0] - before[0])
+    metrics.add('observations.unpublished', after[1] - before[1])
+    metrics.sample('batch.time', time.time() - start, 's')
+    print "Processed: " + str(n) + " (" + threading.current_thread().name + ")"
+  pgconn.close()
+
+# Update the series table with min/max values
+def UpdateSeries(pgcur):
+  sql = "SELECT updateseries FROM updateseries();"
+  pgcur.execute(sql)
+  return pgcur.fetchone()[0]
+
+# Open global database connection
+conn_string = "host='"+DBHOST+"' port='"+DBPORT+"' dbname='"+DATABASE+"' user='"+DBUSER+"' password='" + DBPWD + "'"
+print "Connecting to database..."
+conn, cursor = Connect()
+print "Connected!\n"
+
+# workers and batch size from server, or commandline
+if len(sys.argv) == 3:
+  PROCESSWORKERS = max(1, int(sys.argv[1]))
+  BATCHSIZE = max(1, int(sys.argv[2]))
+else:
+  PROCESSWORKERS = max(1, int(GetConfigFromDbDefault(cursor, 'lml.process.workers', 1)))
+  BATCHSIZE = max(1, int(GetConfigFromDbDefault(cursor, 'lml.process.batchsize', 10)))
+
+LogMsg(cursor, "XMLProcess", "*", "INFO:Start of processing xml files.")
+conn.commit()
+start = time.time()
+metrics.start('process')
+results = Queue.Queue()
+workers = []
+for i in range(PROCESSWORKERS):
+  t = threading.Thread(target=ProcessWorker, args=(BATCHSIZE, results), name="worker " + str(i + 1))
+  t.daemon = True
+  t.start()
+  workers.append(t)
+for t in workers:
+  t.join()
+metrics.stop('process')
+
+total = 0
+errors = 0
+while not results.empty():
+  r = results.get()
+  if isinstance(r, str):
+    print r
+    errors += 1
+  else:
+    total += r
+print "Processed " + str(total) + " files in " + str(round(time.time() - start, 1)) + " s (" + str(PROCESSWORKERS) + " workers, " + str(errors) + " errors)"
+LogMsg(cursor, "XMLProcess", "*", "INFO:End of processing xml files (" + str(total) + ").")
+
+# Finally, udpate the series table
+metrics.start('updateseries')
+if UpdateSeries(cursor):
+  print "Updated metadata successfully."
+metrics.stop('updateseries')
+
+conn.commit()
+
+# Metrics of the run, in one batch
+metrics.add('workers', PROCESSWORKERS)
+metrics.add('phase.total', time.time() - STARTTIME, 's')
+metrics.store(cursor)
+conn.commit()
+print "Metrics stored (run " + metrics.runid + ")"
+conn.close()
+# The end
@@ -10,6 +10,8 @@
 #date            :20140731
 #version         :1.1
 #usage           :python lml-retrieve.py OR lml-retrieve.py [hours] [hours]
+#                 OR lml-retrieve.py backfill [firstday] [lastday]
+#                 (--profile: also report database timings per statement)
 #notes           :Loading data multiple times is harmless when used against
 #                 the lml_import tables and routines (in the database).
 #python_version  :2.7.x
@@ -18,19 +20,28 @@
 # Timestamps ts_* in datatables: transaction time (now()), in order to keep data and logs together.
 # Message log timestamp: real time (clock time)
 
-import os, sys, time
-import urllib2, socket
+import os, sys, time, hashlib, zlib
+import httplib, socket
+import threading, Queue
+from urlparse import urlparse
+from cStringIO import StringIO
+import xml.etree.cElementTree as ET
 import psycopg2
 from datetime import datetime
 from datetime import timedelta
 from sos_config import *
+from lml_metrics import RunMetrics
 
 print """Retrieve and process LML xml export for SOS
 (c) Wouter Boasson, 2014
 """
 
+PROFILE = '--profile' in sys.argv
+if PROFILE:
+  sys.argv.remove('--profile')
+
 if len(sys.argv) == 2  and sys.argv[1] == 'help':
-  print """Usage: lml-retrieve {help} | {[timeframe] [retry-timeframe]}
+  print """Usage: lml-retrieve {help} | {[timeframe] [retry-timeframe]} | {backfill [firstday] [lastday]} {--profile}
   No options:      Uses defaults from database
   help:            This help text.
   timeframe:       Number of hours back from now, to retrieve data for.
@@ -38,11 +49,19 @@ if len(sys.argv) == 2  and sys.argv[1] == 'help':
                    data will be checked for differences (not imported multiple
                    times, only updated). Must be combined with retry-timeframe.
   retry-timeframe: Number of hours back from now, to perform retries for
-                   previously failed downloads (only logged failures).
-                   The webserver will be queried a little slower, and a more
-                   forgiving time out value is set (+10 sec).
+                   previously failed downloads (only logged failures), when
+                   due (the wait doubles with every failed attempt).
+                   Time outs are retried a little slower, with a more
+                   forgiving time out value (+10 sec).
                    Setting this to 0 effectively disables any retries.
                    Must be combined with timeframe.
+  backfill:        Loads all files from firstday up to and including lastday
+                   (YYYYMMDD), day by day. The measurements of a day are
+                   published at once, series metadata is rebuilt at the end.
+                   Completed days are skipped when the backfill is started
+                   again (table backfill_days).
+  --profile:       Also reports the database time per statement, and per
+                   database function when allowed (track_functions).
 """
   sys.exit()
 
@@ -53,6 +72,10 @@ if len(sys.argv) == 2  and sys.argv[1] == 'help':
 #HTTPTIMEOUT = 5
 #RETRYWAIT = 0.05
 #HTTPPROXY = "http://my.proxy.server:port"
+#DOWNLOADWORKERS = 8 (number of concurrent http downloads)
+#RATELIMIT = 20 (max. requests per second per host, 0 = unlimited)
+#PARSEXML = True (parse the xml here, and send the measurements with COPY)
+#COMPRESSXML = True (parsed files: keep the xml zlib compressed, xmldata_gz; not deferred)
 
 # Get the sensors to download
 def GetSensors(pgcur):
@@ -70,32 +93,241 @@ def GetConfigFromDb(pgcur, key):
   pgcur.execute(sql, (key, ))
   return pgcur.fetchone()[0]
 
+# Read optional configuration keys from database
+# (returns the default when the key is not present or null)
+def GetConfigFromDbDefault(pgcur, key, default):
+  sql = "SELECT configvalue FROM configuration WHERE key = %s;"
+  pgcur.execute(sql, (key, ))
+  result = pgcur.fetchone()
+  if result == None or result[0] == None:
+    return default
+  return result[0]
+
+metrics = RunMetrics('lml-retrieve')
+STARTTIME = time.time()
+
+# Cursor that keeps the database time per statement (--profile)
+statements = {}
+
+class ProfileCursor(psycopg2.extensions.cursor):
+  def execute(self, sql, args=None):
+    start = time.time()
+    try:
+      return super(ProfileCursor, self).execute(sql, args)
+    finally:
+      ProfileStatement(sql, time.time() - start)
+
+  def copy_expert(self, sql, file, size=8192):
+    start = time.time()
+    try:
+      return super(ProfileCursor, self).copy_expert(sql, file, size)
+    finally:
+      ProfileStatement(sql, time.time() - start)
+
+def ProfileStatement(sql, seconds):
+  key = " ".join(sql.split())[:80]
+  calls, total = statements.get(key, (0, 0.0))
+  statements[key] = (calls + 1, total + seconds)
+
+# Counters of the current transaction: observations published and unpublished (sos
+# tables), and with --profile the time per function
+def ReadCounters(pgcur):
+  counters = {}
+  sql = """SELECT coalesce(sum(n_tup_ins) FILTER (WHERE relname = 'numericvalue'), 0)
+      , coalesce(sum(n_tup_upd) FILTER (WHERE relname = 'observation'), 0)
+    FROM pg_stat_xact_user_tables
+    WHERE schemaname = 'sos';"""
+  pgcur.execute(sql)
+  published, unpublished = pgcur.fetchone()
+  counters['observations.published'] = (published, '')
+  counters['observations.unpublished'] = (unpublished, '')
+  if PROFILE:
+    sql = """SELECT funcname, calls, total_time, self_time FROM pg_stat_xact_user_functions
+      WHERE schemaname = %s;"""
+    pgcur.execute(sql, (SCHEMA, ))
+    for r in pgcur.fetchall():
+      counters['function.' + r[0] + '.calls'] = (r[1], '')
+      counters['function.' + r[0] + '.total'] = (r[2] / 1000.0, 's')
+      counters['function.' + r[0] + '.self'] = (r[3] / 1000.0, 's')
+  return counters
+
+# Commit, with the counters of the transaction in the metrics; these are the differences
+# with the start of the transaction, as since PostgreSQL 15 the xact statistics also
+# hold the not yet reported counts of earlier transactions of the session
+startcounters = {}
+def CommitCounters():
+  for metric, (value, unit) in ReadCounters(cursor).items():
+    metrics.add(metric, value - startcounters.get(metric, (0, unit))[0], unit)
+  conn.commit()
+  startcounters.clear()
+  startcounters.update(ReadCounters(cursor))
+
+# Print the database timings (--profile)
+def PrintProfile():
+  print ""
+  print "Database time per statement:"
+  for key, (calls, total) in sorted(statements.items(), key=lambda s: -s[1][1]):
+    print "  %8.3f s %7d x  %s" % (total, calls, key)
+  functions = [r for r in metrics.rows() if r[0].startswith('function.') and r[0].endswith('.total')]
+  if len(functions) > 0:
+    print "Database time per function (total, self):"
+    for metric, total, unit in sorted(functions, key=lambda r: -r[1]):
+      name = metric[len('function.'):-len('.total')]
+      print "  %8.3f s %8.3f s %7d x  %s" % (total, metrics.values['function.' + name + '.self'][0], metrics.values['function.' + name + '.calls'][0], name)
+
+# Write the metrics of the run (and report the database timings with --profile)
+def StoreMetrics():
+  metrics.add('phase.total', time.time() - STARTTIME, 's')
+  if PROFILE:
+    PrintProfile()
+    for key, (calls, total) in statements.items():
+      metrics.add('statement.' + key, total, 's')
+  metrics.store(cursor)
+  conn.commit()
+  print "Metrics stored (run " + metrics.runid + ")"
+
+# Persistent (keep-alive) http connection to the LML server, one per download thread
+httplocal = threading.local()
+
+def GetHttpConnection(mytimeout):
+  conn = getattr(httplocal, 'conn', None)
+  if conn != None and conn.timeout == mytimeout:
+    return conn
+  CloseHttpConnection()
+  server = urlparse(LMLSERVER)
+  proxy = os.environ.get('http_proxy', '')
+  if proxy != '' and proxy.find("://") < 0:
+    proxy = "http://" + proxy
+  if server.scheme == 'https':
+    if proxy != '':
+      conn = httplib.HTTPSConnection(urlparse(proxy).netloc, timeout=mytimeout)
+      conn.set_tunnel(server.netloc)
+    else:
+      conn = httplib.HTTPSConnection(server.netloc, timeout=mytimeout)
+  else:
+    if proxy != '':
+      conn = httplib.HTTPConnection(urlparse(proxy).netloc, timeout=mytimeout)
+    else:
+      conn = httplib.HTTPConnection(server.netloc, timeout=mytimeout)
+  httplocal.conn = conn
+  return conn
+
+def CloseHttpConnection():
+  conn = getattr(httplocal, 'conn', None)
+  if conn != None:
+    conn.close()
+  httplocal.conn = None
+
 # Retrieve the files, via http
-def HttpGetFile(myfile, mytimeout):
+# (conditional GET when validators (etag, last-modified) from a previous download are
+# known; returns (data, validators), data is None when the file was not modified)
+def HttpGetFile(myfile, mytimeout, validators=(None, None)):
   fullpath = SOSXML + myfile
-  socket.timeout(HTTPTIMEOUT)
-  req = urllib2.Request(LMLSERVER + fullpath)
-  try:
-    response = urllib2.urlopen(req, timeout=mytimeout)
-  except urllib2.HTTPError as e:
-    print '  the server couldn\'t fulfill the request.'
-    print '  error code:', e.code, fullpath
-    return "ERROR:HTTP " + str(e.code) + " " + LMLSERVER + fullpath
-  except urllib2.URLError as e:
-    print '  we failed to reach a server.'
-    print '  reason:', e.reason, fullpath
-    return "ERROR:URL " + str(e.reason) + " " + LMLSERVER + fullpath
-  except socket.timeout, e:
-    print '  server timeout', fullpath
-    return "ERROR:CONNECTION " + str(e) + " " + LMLSERVER + fullpath
+  server = urlparse(LMLSERVER)
+  if server.scheme != 'https' and os.environ.get('http_proxy', '') != '':
+    requestpath = LMLSERVER + fullpath # plain http proxy: absolute uri
   else:
-    result = response.read()
-    return result
+    requestpath = server.path.rstrip("/") + fullpath
+  headers = {}
+  if validators[0] != None:
+    headers['If-None-Match'] = validators[0]
+  if validators[1] != None:
+    headers['If-Modified-Since'] = validators[1]
+  for attempt in range(2):
+    conn = GetHttpConnection(mytimeout)
+    try:
+      conn.request("GET", requestpath, None, headers)
+      response = conn.getresponse()
+      result = response.read()
+      break
+    except socket.timeout, e:
+      CloseHttpConnection()
+      print '  server timeout', fullpath
+      return ("ERROR:CONNECTION " + str(e) + " " + LMLSERVER + fullpath, validators)
+    except (httplib.HTTPException, socket.error) as e:
+      CloseHttpConnection()
+      if attempt == 0:
+        continue # keep-alive connection closed by the server, reconnect once
+      print '  we failed to reach a server.'
+      print '  reason:', e, fullpath
+      return ("ERROR:URL " + str(e) + " " + LMLSERVER + fullpath, validators)
+  if response.status == 304:
+    return (None, validators)
+  if response.status != 200:
+    print '  the server couldn\'t fulfill the request.'
+    print '  error code:', response.status, fullpath
+    return ("ERROR:HTTP " + str(response.status) + " " + LMLSERVER + fullpath, validators)
+  return (result, (response.getheader('etag'), response.getheader('last-modified')))
+
+# Get the checksums and http validators (etag, last-modified) of the files already
+# in the database (one query for the whole list)
+def GetKnownFiles(pgcur, files):
+  known = {}
+  if len(files) == 0:
+    return known
+  sql = "SELECT xmlfilename, xmldatachksum, http_etag, http_lastmodified FROM xml_files WHERE xmlfilename = ANY(%s);"
+  pgcur.execute(sql, (files, ))
+  for r in pgcur.fetchall():
+    known[r[0]] = (r[1], (r[2], r[3]))
+  return known
 
 # Insert file in database
-def StoreXml(pgcur, filename, xmldata, component, filetime):
-  sql = "SELECT xmlfile_insert(%s, %s, %s, %s);"
-  pgcur.execute(sql, (filename, xmldata, component, filetime))
+# (returns 1: new, 2: unchanged, 3: updated)
+def StoreXml(pgcur, filename, xmldata, component, filetime, validators):
+  sql = "SELECT xmlfile_insert(%s, %s, %s, %s, %s, %s);"
+  pgcur.execute(sql, (filename, xmldata, component, filetime, validators[0], validators[1]))
+  return pgcur.fetchone()[0]
+
+# Insert a parsed file in database, the xml itself is kept zlib compressed
+# (the measurements come from measurements_staging; returns 1: new, 2: unchanged, 3: updated)
+def StoreCompressed(pgcur, filename, xmldata, component, filetime, validators):
+  sql = "SELECT xmlfile_insert_compressed(%s, %s, %s, %s, %s, %s, %s);"
+  pgcur.execute(sql, (filename, psycopg2.Binary(zlib.compress(xmldata)), hashlib.md5(xmldata).hexdigest(), component, filetime, validators[0], validators[1]))
+  return pgcur.fetchone()[0]
+
+# Parse the LML xml (/ROWSET/ROW), one pass over the document; returns a list of
+# (stationcode, value, begin, end) tuples, elements missing from a ROW are None
+def ParseXml(xmldata):
+  rows = []
+  for event, elem in ET.iterparse(StringIO(xmldata)):
+    if elem.tag == 'ROW':
+      rows.append((elem.findtext('STAT_NUMMER'), elem.findtext('MWAA_WAARDE'),
+        elem.findtext('MWAA_BEGINDATUMTIJD'), elem.findtext('MWAA_EINDDATUMTIJD')))
+      elem.clear()
+  return rows
+
+# Format a value for COPY (text format)
+def CopyValue(value):
+  if value == None or value == "":
+    return "\\N"
+  if isinstance(value, unicode):
+    value = value.encode('utf-8')
+  return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+# Send the parsed measurements of a file to the staging table, in one COPY
+# (processed by the xml_files trigger, instead of parsing the xml in the database;
+# rows of a previous version not yet processed by a worker are replaced)
+def StoreParsed(pgcur, filename, rows):
+  pgcur.execute("DELETE FROM measurements_staging WHERE xmlfilename = %s;", (filename, ))
+  buf = StringIO()
+  for row in rows:
+    buf.write("\t".join([CopyValue(v) for v in (filename, ) + row]) + "\n")
+  buf.seek(0)
+  pgcur.copy_expert("COPY measurements_staging (xmlfilename, stationcode, meetwaarde, begindatumtijd, einddatumtijd) FROM STDIN", buf)
+
+# Mark unchanged files as checked, in one batch
+# (same result as xmlfile_insert for unchanged contents; 'unchanged' is a list of
+# (filename, validators) tuples)
+def StoreUnchanged(pgcur, unchanged):
+  if len(unchanged) == 0:
+    return
+  files = [u[0] for u in unchanged]
+  sql = "DELETE FROM download_failures WHERE filename = ANY(%s);"
+  pgcur.execute(sql, (files, ))
+  sql = """UPDATE xml_files x SET ts_checked = now(), http_etag = u.etag, http_lastmodified = u.lastmodified
+    FROM unnest(%s::text[], %s::text[], %s::text[]) AS u(filename, etag, lastmodified)
+    WHERE x.xmlfilename = u.filename;"""
+  pgcur.execute(sql, (files, [u[1][0] for u in unchanged], [u[1][1] for u in unchanged]))
 
 # Insert error message in database
 def LogMsg(pgcur, operation, filename, msg):
@@ -104,41 +336,223 @@ def LogMsg(pgcur, operation, filename, msg):
   pgcur.execute(sql, (operation, filename, msglevel, msg[msg.find(":") + 1:]))
 
 # Insert filename for retry
-def StoreDownloadFailure(pgcur, filename, status):
-  sql = "INSERT INTO download_failures (filename, status, ts_created) values (%s, %s, now());"
-  cursor.execute(sql, (filename, status))
+# (the database counts the attempts of a file, and schedules the next one)
+def StoreDownloadFailure(pgcur, filename, status, laststatus):
+  sql = "INSERT INTO download_failures (filename, status, last_status, ts_created) values (%s, %s, %s, now());"
+  cursor.execute(sql, (filename, status, laststatus))
+
+# Short reason of a failed download, e.g. 'HTTP 404', 'CONNECTION', 'NoData'
+def FailureStatus(data):
+  words = data[6:].split(" ")
+  if words[0] == "HTTP":
+    return " ".join(words[:2])
+  return words[0]
 
-# Get list of files for retry
+# Get list of files for retry: failures of the last 'hours' hours that are due for a
+# next attempt (backoff, see download_failures_insert); returns (files, slowfiles),
+# slowfiles failed on a time out or connection error (or before the attempts were kept)
 def GetFailedDownloads(hours):
   files = []
-  sql = "SELECT filename FROM download_failures WHERE (now() - ts_created) < interval '%s hours';"
+  slowfiles = []
+  sql = """SELECT filename, last_status FROM download_failures
+    WHERE status = 'RETRY' AND ts_nextattempt <= now() AND ts_created > now() - interval '%s hours'
+    ORDER BY ts_nextattempt;"""
   cursor.execute(sql, (hours, ))
   result = cursor.fetchall()
   for r in result:
-    files.append(r[0])
-  return files
+    if r[1] == None or r[1] in ("CONNECTION", "URL"):
+      slowfiles.append(r[0])
+    else:
+      files.append(r[0])
+  return (files, slowfiles)
+
+# Get the logged failures among the given files
+def GetFailedFiles(pgcur, files):
+  sql = "SELECT filename FROM download_failures WHERE status = 'RETRY' AND filename = ANY(%s);"
+  pgcur.execute(sql, (files, ))
+  return [r[0] for r in pgcur.fetchall()]
+
+# Get the days completed by a previous backfill
+def GetBackfillDays(pgcur):
+  sql = "SELECT to_char(day, 'YYYYMMDD') FROM backfill_days;"
+  pgcur.execute(sql)
+  return set([r[0] for r in pgcur.fetchall()])
+
+# Publish the measurements of the given files in one set based step
+def PublishFiles(pgcur, files):
+  sql = "SELECT publish_sos_files(%s);"
+  pgcur.execute(sql, (files, ))
+  return pgcur.fetchone()[0]
+
+# Checkpoint: a backfilled day is complete
+def StoreBackfillDay(pgcur, day, nfiles, observations):
+  sql = """INSERT INTO backfill_days (day, files, observations, ts_done) VALUES (%s, %s, %s, now())
+    ON CONFLICT (day) DO UPDATE SET files = EXCLUDED.files, observations = EXCLUDED.observations, ts_done = EXCLUDED.ts_done;"""
+  pgcur.execute(sql, (day.strftime("%Y-%m-%d"), nfiles, observations))
+
+# Backfill a range of days: files are processed without publishing (per row triggers
+# are skipped), the measurements of a day are published in one set based step, and
+# every day is committed and checkpointed; series metadata is rebuilt once at the end
+def Backfill(firstday, lastday):
+  cursor.execute("SET lml_import.backfill = on;")
+  # monthly partitions for the range (partitioned tables only, see partition_tables)
+  cursor.execute("SELECT create_partitions(%s, %s);", (firstday.strftime("%Y-%m-%d"), lastday.strftime("%Y-%m-%d")))
+  CommitCounters()
+  done = GetBackfillDays(cursor)
+  sensors = GetSensors(cursor)
+  day = firstday
+  while day <= lastday:
+    if day.strftime("%Y%m%d") in done:
+      print "Backfill: " + day.strftime("%Y%m%d") + " done before, skipped"
+      day += timedelta(days = 1)
+      continue
+    files = []
+    for s in sensors:
+      for h in range(24):
+        files.append(day.strftime("%Y%m%d") + "%02d" % h + "-" + s + ".xml")
+    LogMsg(cursor, "HTTPDownload", "*", "INFO:Start of backfill " + day.strftime("%Y%m%d") + ".")
+    interval = 0
+    if RATELIMIT > 0:
+      interval = 1.0 / RATELIMIT
+    metrics.start('downloads')
+    DownloadInsertFiles(files, HTTPTIMEOUT, interval)
+    metrics.stop('downloads')
+    # one retry for the failed downloads of the day
+    metrics.start('retries')
+    DownloadInsertFiles(GetFailedFiles(cursor, files), HTTPTIMEOUT + 10, max(RETRYWAIT, interval))
+    metrics.stop('retries')
+    metrics.start('publish')
+    observations = PublishFiles(cursor, files)
+    metrics.stop('publish')
+    StoreBackfillDay(cursor, day, len(files), observations)
+    LogMsg(cursor, "HTTPDownload", "*", "INFO:End of backfill " + day.strftime("%Y%m%d") + " (" + str(observations) + " observations).")
+    CommitCounters()
+    print "Backfill: " + day.strftime("%Y%m%d") + " published " + str(observations) + " observations"
+    day += timedelta(days = 1)
+  cursor.execute("RESET lml_import.backfill;")
+  metrics.start('updateseries')
+  cursor.execute("SELECT updateseries(true);")
+  metrics.stop('updateseries')
+  CommitCounters()
+  print "Updated metadata successfully."
+
+# Per host rate limiter, shared by the download threads
+# (request starts to the same host are spaced at least 'interval' seconds apart)
+class HostRateLimiter:
+  def __init__(self, interval):
+    self.interval = interval
+    self.lock = threading.Lock()
+    self.nextslot = {}
+
+  def wait(self, host):
+    if self.interval <= 0:
+      return
+    with self.lock:
+      now = time.time()
+      slot = max(now, self.nextslot.get(host, now))
+      self.nextslot[host] = slot + self.interval
+    if slot > now:
+      time.sleep(slot - now)
+
+# Download thread: fetches files from the job queue, hands the data to the main thread
+# (the database is only touched by the main thread, on the global connection)
+def DownloadWorker(jobs, results, mytimeout, limiter):
+  host = urlparse(LMLSERVER).netloc
+  while True:
+    job = jobs.get()
+    if job == None:
+      break
+    myFile, validators = job
+    limiter.wait(host)
+    start = time.time()
+    try:
+      data, validators = HttpGetFile(myFile, mytimeout, validators)
+    except Exception as e:
+      CloseHttpConnection()
+      data = "ERROR:CONNECTION " + str(e) + " " + LMLSERVER + SOSXML + myFile
+    metrics.sample('http.latency', time.time() - start, 's')
+    results.put((myFile, data, validators))
+  CloseHttpConnection()
+
+# Store a downloaded file, or log the failure for retry
+def StoreDownload(myFile, data, validators):
+  stofje = myFile.upper().split("-")[1].replace('.XML', '')
+  myTime = datetime.strptime(myFile.split("-")[0], "%Y%m%d%H")
+  print "Retrieved: " + myFile + " (" + stofje + " " + myTime.strftime("%Y%m%d %H:00:00") + ")"
+  if data[0:6] == "ERROR:":
+    #print data[6:]
+    # Log this (server, filename, timestamp, error code)
+    LogMsg(cursor, "HTTPDownload", myFile, str(data))
+    StoreDownloadFailure(cursor, myFile, "RETRY", FailureStatus(data))
+    metrics.add('files.failed', 1)
+  else:
+    # Stuff it into the database, the database will handle most of the processing
+    if data == "":
+      print "NoData"
+      LogMsg(cursor, "HTTPDownload", myFile, "ERROR:NoData")
+      StoreDownloadFailure(cursor, myFile, "RETRY", "NoData")
+      metrics.add('files.failed', 1)
+    else:
+      rows = []
+      if PARSEXML:
+        try:
+          rows = ParseXml(data)
+        except Exception as e:
+          # leave it to the database (and its error handling)
+          print "Parse error: " + str(e)
+          rows = []
+        if len(rows) > 0:
+          StoreParsed(cursor, myFile, rows)
+      if COMPRESSXML and len(rows) > 0:
+        code = StoreCompressed(cursor, myFile, data, stofje, myTime.strftime("%Y%m%d %H:00:00+01"), validators)
+      else:
+        code = StoreXml(cursor, myFile, data, stofje, myTime.strftime("%Y%m%d %H:00:00+01"), validators)
+      metrics.add({1: 'files.new', 2: 'files.unchanged', 3: 'files.updated'}.get(code, 'files.other'), 1)
 
 # Download and insert a given list of files
-def DownloadInsertFiles(files, mytimeout, sleep):
+# (downloads run concurrently in a pool of DOWNLOADWORKERS threads, request starts
+# are spaced 'interval' seconds apart per host, all inserts go through one connection
+# and one transaction; files not modified since the previous download cost one http 304,
+# downloaded files with a known md5 checksum are not sent to the database again)
+def DownloadInsertFiles(files, mytimeout, interval):
+  if len(files) == 0:
+    return
+  jobs = Queue.Queue()
+  results = Queue.Queue()
+  limiter = HostRateLimiter(interval)
+  known = GetKnownFiles(cursor, files)
   for myFile in files:
-    stofje = myFile.upper().split("-")[1].replace('.XML', '')
-    myTime = datetime.strptime(myFile.split("-")[0], "%Y%m%d%H")
-    print "Retrieving: " + myFile + " (" + stofje + " " + myTime.strftime("%Y%m%d %H:00:00") + ")"
-    data = HttpGetFile(myFile, mytimeout)
-    if data[0:6] == "ERROR:":
-      #print data[6:]
-      # Log this (server, filename, timestamp, error code)
-      LogMsg(cursor, "HTTPDownload", myFile, str(data))
-      StoreDownloadFailure(cursor, myFile, "RETRY")
+    jobs.put((myFile, known.get(myFile, (None, (None, None)))[1]))
+  workers = []
+  for i in range(min(DOWNLOADWORKERS, len(files))):
+    jobs.put(None) # one stop signal per thread
+    t = threading.Thread(target=DownloadWorker, args=(jobs, results, mytimeout, limiter))
+    t.daemon = True
+    t.start()
+    workers.append(t)
+  unchanged = []
+  for i in range(len(files)):
+    myFile, data, fileValidators = results.get()
+    if data == None:
+      print "Not modified: " + myFile
+      unchanged.append((myFile, fileValidators))
+      metrics.add('files.notmodified', 1)
+      continue
+    if data[0:6] != "ERROR:":
+      metrics.add('http.bytes', len(data), 'B')
+    if myFile in known and known[myFile][0] == hashlib.md5(data).hexdigest():
+      print "Unchanged: " + myFile
+      unchanged.append((myFile, fileValidators))
+      metrics.add('files.unchanged.md5', 1)
     else:
-      # Stuff it into the database, the database will handle most of the processing
-      if data == "":
-        print "NoData"
-        LogMsg(cursor, "HTTPDownload", myFile, "ERROR:NoData")
-        StoreDownloadFailure(cursor, myFile, "RETRY")
-      else:
-        StoreXml(cursor, myFile, data, stofje, myTime.strftime("%Y%m%d %H:00:00+01"))
-    time.sleep(sleep)
+      start = time.time()
+      StoreDownload(myFile, data, fileValidators)
+      metrics.add('time.store', time.time() - start, 's')
+  for t in workers:
+    t.join()
+  start = time.time()
+  StoreUnchanged(cursor, unchanged)
+  metrics.add('time.store', time.time() - start, 's')
 
 # Update the series table with min/max values
 def UpdateSeries(pgcur):
@@ -150,7 +564,16 @@ def UpdateSeries(pgcur):
 conn_string = "host='"+DBHOST+"' port='"+DBPORT+"' dbname='"+DATABASE+"' user='"+DBUSER+"' password='" + DBPWD + "'"
 print "Connecting to database..."
 conn = psycopg2.connect(conn_string)
-cursor = conn.cursor()
+if PROFILE:
+  cursor = conn.cursor(cursor_factory=ProfileCursor)
+  try:
+    # time per database function (pg_stat_xact_user_functions), superuser only
+    cursor.execute("SET track_functions = 'pl';")
+  except psycopg2.Error as e:
+    conn.rollback()
+    print "No database time per function: " + str(e).strip()
+else:
+  cursor = conn.cursor()
 cursor.execute("SET search_path = " + SCHEMA + ",public;")
 print "Connected!\n"
 
@@ -160,11 +583,26 @@ SOSXML = GetConfigFromDb(cursor, 'lml.server.directory')
 HTTPTIMEOUT = float(GetConfigFromDb(cursor, 'http.timeout'))
 RETRYWAIT = float(GetConfigFromDb(cursor, 'http.retrywait'))
 HTTPPROXY = GetConfigFromDb(cursor, 'http.proxy')
+DOWNLOADWORKERS = max(1, int(GetConfigFromDbDefault(cursor, 'lml.retrieve.workers', 1)))
+RATELIMIT = float(GetConfigFromDbDefault(cursor, 'http.ratelimit', 0))
+PARSEXML = GetConfigFromDbDefault(cursor, 'lml.retrieve.parse', 'F') == 'T'
+# (not with deferred processing: the parsed rows would wait in the unlogged staging table)
+COMPRESSXML = GetConfigFromDbDefault(cursor, 'lml.retrieve.compress', 'F') == 'T'
+if COMPRESSXML and GetConfigFromDbDefault(cursor, 'lml.process.deferred', 'F') == 'T':
+  print "Warning: lml.retrieve.compress is ignored with lml.process.deferred, files are stored as xml"
+  COMPRESSXML = False
 
 # Set the proxy
 if HTTPPROXY != None:
   os.environ['http_proxy'] = HTTPPROXY
 
+# Backfill a range of days, instead of the regular download
+if len(sys.argv) == 4 and sys.argv[1] == 'backfill':
+  Backfill(datetime.strptime(sys.argv[2], "%Y%m%d"), datetime.strptime(sys.argv[3], "%Y%m%d"))
+  StoreMetrics()
+  conn.close()
+  sys.exit()
+
 # timeframes from server, or commandline
 if len(sys.argv) == 3:
   timeframe = int(sys.argv[1]) # hours back from now, regular download
@@ -183,21 +621,40 @@ for s in GetSensors(cursor):
     myTime = now - timedelta(hours = i)
     myFile = myTime.strftime("%Y%m%d%H") + "-" + s + ".xml"
     files.append(myFile)
-DownloadInsertFiles(files, HTTPTIMEOUT, 0.001)
+# Failed downloads that are due: missing files (http errors, no data) are simply added
+# to the regular downloads, time outs and connection errors are retried afterwards
+retries, slowretries = GetFailedDownloads(retrytimeframe)
+regular = set(files)
+files += [f for f in retries if f not in regular]
+slowretries = [f for f in slowretries if f not in regular]
+print "Downloads: " + str(len(regular)) + ", retries: " + str(len(files) - len(regular)) + " + " + str(len(slowretries))
+metrics.start('downloads')
+if RATELIMIT > 0:
+  DownloadInsertFiles(files, HTTPTIMEOUT, 1.0 / RATELIMIT)
+else:
+  DownloadInsertFiles(files, HTTPTIMEOUT, 0)
+metrics.stop('downloads')
 LogMsg(cursor, "HTTPDownload", "*", "INFO:End of http downloads.")
-conn.commit()
+CommitCounters()
 
-# Get the download failures and retry, being a bit more forgiving to the webserver
-files = GetFailedDownloads(retrytimeframe)
+# Retry the time outs and connection errors, being a bit more forgiving to the webserver
 LogMsg(cursor, "HTTPDownload", "*", "INFO:Start of retrying failed http downloads.")
-DownloadInsertFiles(files, HTTPTIMEOUT + 10, RETRYWAIT)
+metrics.start('retries')
+if RATELIMIT > 0:
+  DownloadInsertFiles(slowretries, HTTPTIMEOUT + 10, max(RETRYWAIT, 1.0 / RATELIMIT))
+else:
+  DownloadInsertFiles(slowretries, HTTPTIMEOUT + 10, RETRYWAIT)
+metrics.stop('retries')
 LogMsg(cursor, "HTTPDownload", "*", "INFO:End of retrying failed http downloads.")
-conn.commit()
+CommitCounters()
 
 # Finally, udpate the series table
+metrics.start('updateseries')
 if UpdateSeries(cursor):
   print "Updated metadata successfully."
+metrics.stop('updateseries')
+CommitCounters()
 
-conn.commit()
+StoreMetrics()
 conn.close()
 # The end
@@ -0,0 +1,1946 @@
+--
+-- Upgrade of the lml_import schema, on top of lml_import.sql (version 1.1)
+--
+-- Load after lml_import.sql, for new and existing installations:
+--   psql -f lml_import-upgrade.sql -d <sosdatabase>
+-- All statements are idempotent, the script can (and should) be loaded again
+-- after every update of sos4lml. Requires PostgreSQL 9.6 or later.
+--
+
+SET statement_timeout = 0;
+SET client_encoding = 'UTF8';
+SET standard_conforming_strings = on;
+SET check_function_bodies = false;
+SET client_min_messages = warning;
+
+SET search_path = lml_import, pg_catalog;
+
+--
+-- Name: xml_files; Type: TABLE; Schema: lml_import; Owner: -
+-- http validators of the last download (conditional GET), and the raw file compressed
+-- by lml-retrieve.py (lml.retrieve.compress, xmldata is empty then)
+--
+
+ALTER TABLE xml_files ADD COLUMN IF NOT EXISTS http_etag text;
+ALTER TABLE xml_files ADD COLUMN IF NOT EXISTS http_lastmodified text;
+ALTER TABLE xml_files ADD COLUMN IF NOT EXISTS xmldata_gz bytea;
+
+
+--
+-- Name: measurements_staging; Type: TABLE; Schema: lml_import; Owner: -
+-- Measurements parsed by lml-retrieve.py (lml.retrieve.parse), LML names and text values
+-- as in the xml. Consumed by lml_xmlfile_process() in the same transaction, or later by
+-- process_xml_files() (lml.process.deferred). Unlogged: the rows of files waiting for
+-- lml-process.py are lost in a crash, those files are then parsed from xmldata again
+-- (files stored compressed are never deferred, see lml-retrieve.py).
+--
+
+CREATE UNLOGGED TABLE IF NOT EXISTS measurements_staging (
+    xmlfilename text NOT NULL,
+    stationcode text,
+    meetwaarde text,
+    begindatumtijd text,
+    einddatumtijd text
+);
+
+CREATE INDEX IF NOT EXISTS measurements_staging_xmlfilename_idx ON measurements_staging USING btree (xmlfilename);
+
+
+--
+-- Name: xmlfile_store(text, xml, bytea, text, text, timestamp with time zone, text, text); Type: FUNCTION; Schema: lml_import; Owner: -
+-- Body of xmlfile_insert, for the xml or the compressed raw file (xml_gz, measurements
+-- parsed by lml-retrieve.py in measurements_staging). The checksum is computed by the caller.
+--
+
+CREATE OR REPLACE FUNCTION xmlfile_store(xml_filename text, xml_data xml, xml_gz bytea, datachksum text, the_component text, xmlfile_timestamp timestamp with time zone, xml_etag text, xml_lastmodified text) RETURNS integer
+    LANGUAGE plpgsql
+    AS $_$
+DECLARE
+  datacheck text;
+BEGIN
+  -- always delete entry from download_status (safe, all in one transaction and this function
+  -- has no return path without action)
+  DELETE FROM lml_import.download_failures WHERE filename = xml_filename;
+
+  -- one row per file name: xml_files partitioned by month (partition_tables) only has
+  -- xmlfilename unique together with ts_xmlfile, stores of the same file wait for each other
+  PERFORM pg_advisory_xact_lock(hashtext('lml_import.xml_files'), hashtext(xml_filename));
+
+  -- check if already present, based on name (one lookup on the xmlfilename index; not an
+  -- INSERT ... ON CONFLICT, the insert trigger would process the file before the conflict)
+  SELECT xmldatachksum INTO datacheck FROM lml_import.xml_files WHERE xmlfilename = xml_filename;
+  IF NOT FOUND THEN -- insert
+    INSERT INTO lml_import.xml_files(
+                xmlfilename, xmldata, xmldata_gz, xmldatachksum, component, ts_xmlfile,
+                ts_created, http_etag, http_lastmodified)
+        VALUES (xml_filename, xml_data, xml_gz, datachksum, the_component, xmlfile_timestamp, now()
+                , xml_etag, xml_lastmodified);
+    RETURN 1;
+  ELSE -- check/update
+    RAISE NOTICE 'Checksum %', datacheck;
+    IF (datacheck = datachksum) THEN -- present, same contents, update checked
+      RAISE NOTICE 'Checked %', xml_filename;
+      DELETE FROM lml_import.measurements_staging WHERE xmlfilename = xml_filename;
+      UPDATE lml_import.xml_files SET ts_checked = now()
+          , http_etag = xml_etag, http_lastmodified = xml_lastmodified
+        WHERE xmlfilename = xml_filename;
+      RETURN 2;
+    ELSE
+      RAISE NOTICE 'Update %', xml_filename;
+      UPDATE lml_import.xml_files SET xmldata = xml_data, xmldata_gz = xml_gz, xmldatachksum = datachksum
+          , ts_checked = now(), ts_updated = now()
+          , http_etag = xml_etag, http_lastmodified = xml_lastmodified
+        WHERE xmlfilename = xml_filename;
+      RETURN 3;
+    END IF;
+  END IF;
+END;
+$_$;
+
+
+--
+-- Name: xmlfile_insert(text, xml, text, timestamp with time zone, text, text); Type: FUNCTION; Schema: lml_import; Owner: -
+-- Replaces xmlfile_insert(text, xml, text, timestamp with time zone), stores the http validators.
+--
+
+DROP FUNCTION IF EXISTS xmlfile_insert(text, xml, text, timestamp with time zone);
+
+CREATE OR REPLACE FUNCTION xmlfile_insert(xml_filename text, xml_data xml, the_component text, xmlfile_timestamp timestamp with time zone, xml_etag text DEFAULT NULL, xml_lastmodified text DEFAULT NULL) RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+  RETURN lml_import.xmlfile_store(xml_filename, xml_data, NULL, md5(xml_data::text)
+    , the_component, xmlfile_timestamp, xml_etag, xml_lastmodified);
+END;
+$$;
+
+
+--
+-- Name: xmlfile_insert_compressed(text, bytea, text, text, timestamp with time zone, text, text); Type: FUNCTION; Schema: lml_import; Owner: -
+-- xmlfile_insert for a file parsed by lml-retrieve.py: the measurements in measurements_staging
+-- are the source of truth, the raw file is only kept compressed (no xml cast).
+--
+
+CREATE OR REPLACE FUNCTION xmlfile_insert_compressed(xml_filename text, xml_gz bytea, xml_chksum text, the_component text, xmlfile_timestamp timestamp with time zone, xml_etag text DEFAULT NULL, xml_lastmodified text DEFAULT NULL) RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+  RETURN lml_import.xmlfile_store(xml_filename, NULL, xml_gz, xml_chksum
+    , the_component, xmlfile_timestamp, xml_etag, xml_lastmodified);
+END;
+$$;
+
+
+--
+-- Name: publish_sos_files(text[]); Type: FUNCTION; Schema: lml_import; Owner: -
+-- Set based publication of the (not yet published) measurements of the given files:
+-- series, offering, unit and codespace come from publish_targets (one join),
+-- the three sos tables are written with one INSERT ... SELECT each. Stations/sensors
+-- that are not prepared in the SOS (no series or offering) are skipped and logged in
+-- message_log (SOSPublish, ERROR), their measurements stay unpublished.
+--
+
+CREATE OR REPLACE FUNCTION publish_sos_files(xml_filenames text[]) RETURNS bigint
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+  -- result: number of published observations
+  n bigint;
+  unresolved bigint[];
+BEGIN
+  -- resolve again the targets that were not (fully) known in the SOS at the last refresh
+  unresolved := ARRAY(SELECT DISTINCT p.statsensunit_id
+    FROM lml_import.measurements m
+    JOIN lml_import.publish_targets p
+      ON p.station_id = m.station_id
+      AND p.sensorcode = m.sensorcode
+    WHERE m.xmlfilename = ANY(xml_filenames)
+      AND p.publish_sos = true
+      AND (p.series_id IS NULL OR p.offering_id IS NULL));
+  IF cardinality(unresolved) > 0 THEN
+    PERFORM lml_import.refresh_publish_targets(unresolved);
+  END IF;
+
+  WITH targets AS (
+    -- station, sensor, unit to publish (same selection as publish_sos: first match)
+    SELECT DISTINCT ON (p.station_id, p.sensorcode) p.*
+    FROM lml_import.publish_targets p
+    WHERE p.publish_sos = true
+    ORDER BY p.station_id, p.sensorcode, p.statsensunit_id
+  ), todo AS (
+    -- omit the typical nodata values, and measurements that are already published
+    SELECT m.id, nextval('sos.observationid_seq'::regclass) AS obs_id
+      , t.series_id, t.offering_id, t.unit_id, t.codespace_id, t.geom
+      , t.observation_uri || m.id::text AS obs_uri
+      , m.m_value, m.begindatetime, m.enddatetime
+    FROM lml_import.measurements m
+    JOIN targets t
+      ON t.station_id = m.station_id
+      AND t.sensorcode = m.sensorcode
+    WHERE m.xmlfilename = ANY(xml_filenames)
+      AND m.sos_observationid IS NULL
+      AND (m.m_value < -900) IS NOT TRUE
+      AND t.series_id IS NOT NULL
+      AND t.offering_id IS NOT NULL
+  ), skipped AS (
+    -- stations/sensors not (yet) prepared in the SOS: not published, logged
+    INSERT INTO lml_import.message_log (msgtimestamp, operation, filename, msglevel, msg, ts_created)
+      SELECT clock_timestamp(), 'SOSPublish', m.xmlfilename, 'ERROR'
+        , format('Station/sensor %s/%s is not prepared in the SOS, %s measurements not published', t.publishstationcode, t.sensorcode, count(*))
+        , now()
+      FROM lml_import.measurements m
+      JOIN targets t
+        ON t.station_id = m.station_id
+        AND t.sensorcode = m.sensorcode
+      WHERE m.xmlfilename = ANY(xml_filenames)
+        AND m.sos_observationid IS NULL
+        AND (m.m_value < -900) IS NOT TRUE
+        AND (t.series_id IS NULL OR t.offering_id IS NULL)
+      GROUP BY m.xmlfilename, t.publishstationcode, t.sensorcode
+  ), obs AS (
+    -- insert the observations
+    INSERT INTO sos.observation(
+              observationid, seriesid, phenomenontimestart, phenomenontimeend,
+              resulttime, identifier, codespaceid, deleted, unitid, samplinggeometry)
+      SELECT obs_id, series_id
+        , begindatetime AT TIME ZONE 'UTC'
+        , enddatetime AT TIME ZONE 'UTC'
+        , now() AT TIME ZONE 'UTC'
+        , obs_uri
+        , codespace_id
+        , 'F'
+        , unit_id
+        , geom
+      FROM todo
+  ), val AS (
+    -- insert the measured values
+    INSERT INTO sos.numericvalue (observationid, value)
+      SELECT obs_id, m_value FROM todo
+  ), offer AS (
+    -- insert the links to the offering
+    INSERT INTO sos.observationhasoffering (observationid, offeringid)
+      SELECT obs_id, offering_id FROM todo
+  ), dirty AS (
+    -- series metadata to update (updateseries)
+    INSERT INTO lml_import.series_dirty (seriesid, mintime, removed, ts_created)
+      SELECT series_id, min(enddatetime) AT TIME ZONE 'UTC', false, now()
+      FROM todo
+      GROUP BY series_id
+  )
+  -- keep track of the link between the source rows and sos observations
+  UPDATE lml_import.measurements m
+    SET sos_observationid = todo.obs_id
+    FROM todo
+    WHERE m.id = todo.id;
+
+  GET DIAGNOSTICS n = ROW_COUNT;
+  RETURN n;
+END;
+$$;
+
+
+--
+-- Name: xmlfile_process_measurements(text, xml, text); Type: FUNCTION; Schema: lml_import; Owner: -
+-- Parse-and-publish step of one xml file (was the body of lml_xmlfile_process).
+-- The measurements of a previous version are unpublished in one set based step.
+-- With 'sos.publish.setbased' = 'T' the per row publish_sos trigger is skipped,
+-- the measurements of the file are published in one set based step.
+-- During a backfill (session setting lml_import.backfill = on) nothing is published,
+-- lml-retrieve.py publishes all files of a day at once.
+-- Measurements already parsed by lml-retrieve.py are taken from measurements_staging,
+-- only files without staged rows are parsed here. A file only kept compressed
+-- (xmldata_gz) cannot be parsed here: without staged rows it is an error.
+--
+
+CREATE OR REPLACE FUNCTION xmlfile_process_measurements(xml_filename text, xml_data xml, the_component text) RETURNS void
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+  setbased boolean;
+  backfill boolean;
+BEGIN
+  -- DELETE OLD STUFF
+  PERFORM lml_import.unpublish_sos_files(ARRAY[xml_filename]);
+  DELETE FROM lml_import.measurements WHERE xmlfilename = xml_filename;
+
+  -- Per row or set based publication, or none at all (backfill)
+  backfill := coalesce(current_setting('lml_import.backfill', true) = 'on', false);
+  setbased := NOT backfill AND coalesce((SELECT configvalue FROM lml_import.configuration WHERE key = 'sos.publish.setbased') = 'T', false);
+  IF setbased OR backfill THEN
+    PERFORM set_config('lml_import.publish_deferred', 'on', true);
+  END IF;
+
+  -- INSERT NEW (this is all LML stuff: LML names used)
+  IF EXISTS (SELECT 1 FROM lml_import.measurements_staging WHERE xmlfilename = xml_filename) THEN
+    -- parsed by lml-retrieve.py
+    INSERT INTO lml_import.measurements (xmlfilename, station_id, sensorcode, m_value, begindatetime, enddatetime)
+    select
+      xml_filename
+      , lml_import.getstationid(stationcode::character varying (16))
+      , the_component
+      , meetwaarde::float
+      , lml_import.lml_datetimeparse_tz(begindatumtijd::character varying (16), 'CET') as begindatetime
+      , lml_import.lml_datetimeparse_tz(einddatumtijd::character varying (16), 'CET') as enddatetime
+    from lml_import.measurements_staging
+    where xmlfilename = xml_filename
+    ;
+    DELETE FROM lml_import.measurements_staging WHERE xmlfilename = xml_filename;
+  ELSIF xml_data IS NULL AND EXISTS (SELECT 1 FROM lml_import.xml_files WHERE xmlfilename = xml_filename AND xmldata_gz IS NOT NULL) THEN
+    RAISE EXCEPTION 'No measurements of compressed file % (staged rows lost), download it again', xml_filename;
+  ELSE
+    INSERT INTO lml_import.measurements (xmlfilename, station_id, sensorcode, m_value, begindatetime, enddatetime)
+    with xp as
+    (select
+      xml_filename as xmlfilename
+      , the_component as component
+      , unnest(xpath('/ROWSET/ROW/STAT_NUMMER/text()', xml_data))::character varying (16) as stationcode
+      , unnest(xpath('/ROWSET/ROW/MWAA_WAARDE/text()', xml_data))::text::float as meetwaarde
+      , unnest(xpath('/ROWSET/ROW/MWAA_BEGINDATUMTIJD/text()', xml_data))::character varying (16) as begindatumtijd
+      , unnest(xpath('/ROWSET/ROW/MWAA_EINDDATUMTIJD/text()', xml_data))::character varying (16) as einddatumtijd
+    )
+    -- Here translation to more generic names takes place, by inserting them in the measurements table.
+    select
+      xmlfilename
+      , lml_import.getstationid(stationcode)
+      , component
+      , meetwaarde
+      , lml_import.lml_datetimeparse_tz(begindatumtijd, 'CET') as begindatetime
+      , lml_import.lml_datetimeparse_tz(einddatumtijd, 'CET') as enddatetime
+    from xp
+    ;
+  END IF;
+
+  IF setbased THEN
+    PERFORM set_config('lml_import.publish_deferred', 'off', true);
+    PERFORM lml_import.publish_sos_files(ARRAY[xml_filename]);
+  END IF;
+END;
+$$;
+
+
+--
+-- Name: lml_xmlfile_process(); Type: FUNCTION; Schema: lml_import; Owner: -
+-- With 'lml.process.deferred' = 'T' files are only stored, and processed by the
+-- lml-process.py workers (process_xml_files); not during a backfill.
+--
+
+CREATE OR REPLACE FUNCTION lml_xmlfile_process() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+  IF (NEW.ts_processed is NULL OR NEW.ts_processed < NEW.ts_updated) THEN
+    -- Leave it to the workers (the file stays in vw_xmltoprocess)
+    IF (SELECT configvalue FROM lml_import.configuration WHERE key = 'lml.process.deferred') = 'T'
+        AND current_setting('lml_import.backfill', true) IS DISTINCT FROM 'on' THEN
+      RETURN NEW;
+    END IF;
+    PERFORM lml_import.xmlfile_process_measurements(NEW.xmlfilename, NEW.xmldata, NEW.component);
+  NEW.ts_processed = now();
+  END IF;
+  RETURN NEW;
+END;
+$$;
+
+
+--
+-- Name: process_xml_files(integer); Type: FUNCTION; Schema: lml_import; Owner: -
+-- Processes up to batch_size files of vw_xmltoprocess. Files are claimed with
+-- FOR UPDATE SKIP LOCKED, so several workers (connections) can run at the same time.
+-- A file that fails is logged in message_log (XMLProcess, ERROR) and leaves the queue
+-- as well (ts_processed set), the other files of the batch are processed; clear its
+-- ts_processed to process it again. Deadlocks abort the batch (the worker retries it).
+-- Returns the number of processed files, 0 when there is nothing (left) to do.
+--
+
+CREATE OR REPLACE FUNCTION process_xml_files(batch_size integer) RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+  f record;
+  n integer := 0;
+BEGIN
+  FOR f IN
+    SELECT x.id, x.xmlfilename, x.xmldata, x.component
+    FROM lml_import.xml_files x
+    WHERE x.ts_processed IS NULL OR x.ts_updated > x.ts_processed
+    ORDER BY x.id
+    LIMIT batch_size
+    FOR UPDATE SKIP LOCKED
+  LOOP
+    BEGIN
+      PERFORM lml_import.xmlfile_process_measurements(f.xmlfilename, f.xmldata, f.component);
+    EXCEPTION
+      WHEN deadlock_detected OR serialization_failure THEN
+        RAISE;
+      WHEN others THEN
+        INSERT INTO lml_import.message_log (msgtimestamp, operation, filename, msglevel, msg, ts_created)
+          VALUES (clock_timestamp(), 'XMLProcess', f.xmlfilename, 'ERROR', SQLERRM, now());
+    END;
+    UPDATE lml_import.xml_files SET ts_processed = now() WHERE id = f.id;
+    n := n + 1;
+  END LOOP;
+  RETURN n;
+END;
+$$;
+
+
+--
+-- Name: insert_publish_sos; Type: TRIGGER; Schema: lml_import; Owner: -
+-- Skipped while a set based publication is pending (lml_import.publish_deferred).
+--
+
+DROP TRIGGER IF EXISTS insert_publish_sos ON measurements;
+
+CREATE TRIGGER insert_publish_sos BEFORE INSERT ON measurements FOR EACH ROW WHEN (current_setting('lml_import.publish_deferred', true) IS DISTINCT FROM 'on') EXECUTE PROCEDURE publish_sos();
+
+
+
+--
+-- Name: series_dirty; Type: TABLE; Schema: lml_import; Owner: -
+-- Series with observations published or removed since the last updateseries():
+-- mintime is the earliest (phenomenon end) time published, removed is set when
+-- observations of the series were removed. Insert only (no upsert), a series can
+-- have several rows: concurrent transactions do not wait for each other's row locks.
+--
+
+CREATE TABLE IF NOT EXISTS series_dirty (
+    seriesid bigint NOT NULL,
+    mintime timestamp without time zone,
+    removed boolean DEFAULT false NOT NULL,
+    ts_created timestamp with time zone
+);
+
+ALTER TABLE series_dirty DROP CONSTRAINT IF EXISTS series_dirty_pkey;
+
+CREATE INDEX IF NOT EXISTS series_dirty_seriesid_idx ON series_dirty USING btree (seriesid);
+
+
+--
+-- Name: mark_series_dirty(bigint, timestamp without time zone, boolean); Type: FUNCTION; Schema: lml_import; Owner: -
+--
+
+CREATE OR REPLACE FUNCTION mark_series_dirty(series_id bigint, obs_time timestamp without time zone, obs_removed boolean) RETURNS void
+    LANGUAGE sql
+    AS $$
+INSERT INTO lml_import.series_dirty (seriesid, mintime, removed, ts_created)
+  SELECT series_id, obs_time, obs_removed, now()
+  WHERE NOT EXISTS (
+    -- already covered by an earlier mark
+    SELECT 1 FROM lml_import.series_dirty d
+    WHERE d.seriesid = series_id
+      AND d.mintime <= obs_time
+      AND (d.removed OR NOT obs_removed));
+$$;
+
+
+--
+-- Name: publish_sos(); Type: FUNCTION; Schema: lml_import; Owner: -
+-- One lookup in publish_targets, publish_observation does the rest.
+--
+
+CREATE OR REPLACE FUNCTION publish_sos() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+  t lml_import.publish_targets%ROWTYPE;
+BEGIN
+  -- call the publish_observation function, but before that look up the publishing
+  -- metadata of station and sensor in publish_targets (one indexed lookup).
+
+  -- Omit specific values (the typical nodata values)
+  IF NEW.m_value < -900 THEN
+    -- Insert into meetreeks, do not publish to sos.
+    -- Alternative: RETURN NULL; that would skip it entirely.
+    RETURN NEW;
+  END IF;
+
+  -- Get station, sensor, unit
+  SELECT * INTO t
+  FROM lml_import.publish_targets p
+  WHERE p.station_id = NEW.station_id
+  AND p.sensorcode = NEW.sensorcode
+  AND p.publish_sos = true
+  ORDER BY p.statsensunit_id
+  LIMIT 1;
+
+  -- Check for active. If no result, do not take action.
+  IF NOT FOUND THEN
+    RETURN NEW;
+  ELSE
+    NEW.sos_observationid := lml_import.publish_observation(
+      t
+      , nextval('sos.observationid_seq'::regclass)
+      , NEW.id
+      , t.geom
+      , NEW.m_value
+      , t.m_unit
+      , NEW.begindatetime -- must be with time zone!
+      , NEW.enddatetime
+      , now()
+    );
+    RETURN NEW;
+  END IF;
+END;
+$$;
+
+
+--
+-- Name: unpublish_pending; Type: TABLE; Schema: lml_import; Owner: -
+-- Observations marked deleted by the current statement, purged by purge_unpublished().
+--
+
+CREATE TABLE IF NOT EXISTS unpublish_pending (
+    observationid bigint NOT NULL PRIMARY KEY
+);
+
+
+--
+-- Name: unpublish_sos(); Type: FUNCTION; Schema: lml_import; Owner: -
+-- Marks the series of the removed observation dirty. The removal from the sos tables
+-- (sos.autoremove.deleted) is done once per statement by purge_unpublished().
+--
+
+CREATE OR REPLACE FUNCTION unpublish_sos() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+  series_id bigint;
+  obs_time timestamp without time zone;
+BEGIN
+  -- Mark observations to delete
+  UPDATE sos.observation
+  SET deleted = 'T'
+  WHERE observationid = OLD.sos_observationid
+  RETURNING seriesid, phenomenontimeend INTO series_id, obs_time;
+
+  IF series_id IS NOT NULL THEN
+    -- series metadata to update (updateseries)
+    PERFORM lml_import.mark_series_dirty(series_id, obs_time, true);
+    -- to be purged at the end of the statement
+    INSERT INTO lml_import.unpublish_pending (observationid)
+      VALUES (OLD.sos_observationid)
+      ON CONFLICT DO NOTHING;
+  END IF;
+
+  RETURN OLD;
+END;
+$$;
+
+
+--
+-- Name: purge_unpublished(); Type: FUNCTION; Schema: lml_import; Owner: -
+-- Statement trigger: removes the observations marked deleted by unpublish_sos during
+-- the statement, and only those.
+--
+
+CREATE OR REPLACE FUNCTION purge_unpublished() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+  -- The next steps are introduced as a workaround for a bug in the SOS software,
+  -- but can be left in place.
+  IF (SELECT configvalue FROM lml_import.configuration WHERE key = 'sos.autoremove.deleted') = 'T' THEN
+    DELETE FROM sos.numericvalue v
+      USING lml_import.unpublish_pending p
+      WHERE v.observationid = p.observationid
+    ;
+    DELETE FROM sos.observationhasoffering o
+      USING lml_import.unpublish_pending p
+      WHERE o.observationid = p.observationid
+    ;
+    DELETE FROM sos.observation o
+      USING lml_import.unpublish_pending p
+      WHERE o.observationid = p.observationid
+        AND o.deleted = 'T'
+    ;
+  END IF;
+  -- end of workaround
+
+  DELETE FROM lml_import.unpublish_pending;
+  RETURN NULL;
+END;
+$$;
+
+
+--
+-- Name: delete_purge_unpublished; Type: TRIGGER; Schema: lml_import; Owner: -
+--
+
+DROP TRIGGER IF EXISTS delete_purge_unpublished ON measurements;
+
+CREATE TRIGGER delete_purge_unpublished AFTER DELETE ON measurements FOR EACH STATEMENT EXECUTE PROCEDURE purge_unpublished();
+
+
+--
+-- Name: delete_unpublish_sos; Type: TRIGGER; Schema: lml_import; Owner: -
+-- Only for published measurements (unpublish_sos_files unlinks them beforehand), and not
+-- when the cache is cleaned up (apply_retention: the observations stay in the SOS).
+--
+
+DROP TRIGGER IF EXISTS delete_unpublish_sos ON measurements;
+
+CREATE TRIGGER delete_unpublish_sos AFTER DELETE ON measurements FOR EACH ROW WHEN ((OLD.sos_observationid IS NOT NULL) AND (current_setting('lml_import.retention', true) IS DISTINCT FROM 'on')) EXECUTE PROCEDURE unpublish_sos();
+
+
+--
+-- Name: unpublish_sos_files(text[]); Type: FUNCTION; Schema: lml_import; Owner: -
+-- Set based unpublish_sos for the measurements of the given files, before they are
+-- deleted: observations are marked deleted (and purged by the delete statement, see
+-- purge_unpublished), series marked dirty, the measurements unlinked.
+--
+
+CREATE OR REPLACE FUNCTION unpublish_sos_files(xml_filenames text[]) RETURNS bigint
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+  -- result: number of unpublished observations
+  n bigint;
+BEGIN
+  WITH obs AS (
+    -- Mark observations to delete
+    UPDATE sos.observation o
+      SET deleted = 'T'
+      FROM lml_import.measurements m
+      WHERE m.xmlfilename = ANY(xml_filenames)
+        AND o.observationid = m.sos_observationid
+      RETURNING o.observationid, o.seriesid, o.phenomenontimeend
+  ), dirty AS (
+    -- series metadata to update (updateseries)
+    INSERT INTO lml_import.series_dirty (seriesid, mintime, removed, ts_created)
+      SELECT seriesid, min(phenomenontimeend), true, now()
+      FROM obs
+      GROUP BY seriesid
+  ), pending AS (
+    -- to be purged at the end of the delete statement
+    INSERT INTO lml_import.unpublish_pending (observationid)
+      SELECT observationid FROM obs
+      ON CONFLICT DO NOTHING
+  )
+  UPDATE lml_import.measurements m
+    SET sos_observationid = NULL
+    WHERE m.xmlfilename = ANY(xml_filenames)
+      AND m.sos_observationid IS NOT NULL;
+
+  GET DIAGNOSTICS n = ROW_COUNT;
+  RETURN n;
+END;
+$$;
+
+
+--
+-- Name: purge_deleted_observations(); Type: FUNCTION; Schema: lml_import; Owner: -
+-- Maintenance: removes all observations marked deleted in the sos tables, also those
+-- deleted by other means (e.g. the SOS DeleteObservation request). Their series are marked
+-- dirty with a full recompute (updateseries), the SOS does not tell us about its deletes.
+-- Returns the number of removed observations.
+--
+
+CREATE OR REPLACE FUNCTION purge_deleted_observations() RETURNS bigint
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+  n bigint;
+BEGIN
+  -- series metadata to update (updateseries)
+  INSERT INTO lml_import.series_dirty (seriesid, mintime, removed, ts_created)
+    SELECT seriesid, min(phenomenontimeend), true, now()
+    FROM sos.observation
+    WHERE deleted = 'T'
+    GROUP BY seriesid;
+
+  DELETE FROM sos.numericvalue
+  WHERE observationid IN (
+    SELECT observationid
+    FROM sos.observation
+    WHERE deleted = 'T')
+  ;
+  DELETE FROM sos.observationhasoffering
+  WHERE observationid IN (
+    SELECT observationid
+    FROM sos.observation
+    WHERE deleted = 'T')
+  ;
+  DELETE FROM sos.observation
+  WHERE deleted = 'T'
+  ;
+  GET DIAGNOSTICS n = ROW_COUNT;
+  RETURN n;
+END;
+$$;
+
+
+--
+-- Name: updateseries(boolean); Type: FUNCTION; Schema: lml_import; Owner: -
+-- Replaces updateseries(): only the series in series_dirty are updated. When observations
+-- were only appended, just the last timestamp/value is looked up; a series that lost
+-- observations (removed) is recomputed. The full recompute over all observations (the
+-- original updateseries) is a maintenance option:
+--   SELECT lml_import.updateseries(true);
+--
+
+DROP FUNCTION IF EXISTS updateseries();
+
+CREATE OR REPLACE FUNCTION updateseries(full_recompute boolean DEFAULT false) RETURNS boolean
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+  d record;
+  first_obs record;
+  last_obs record;
+  dirty_ids bigint[];
+  dirty_mintimes timestamp without time zone[];
+  dirty_removed boolean[];
+BEGIN
+  IF full_recompute THEN
+    UPDATE sos.series s
+      SET firsttimestamp = u.firsttimestamp
+        , lasttimestamp = u.lasttimestamp
+        , firstnumericvalue = u.firstnumericvalue
+        , lastnumericvalue = u.lastnumericvalue
+      FROM (
+        WITH mm AS
+          (SELECT seriesid
+              , min(o.phenomenontimeend) d_min, max(o.phenomenontimeend) d_max
+            FROM sos.observation o
+            JOIN sos.numericvalue n
+              ON o.observationid = n.observationid
+              WHERE o.deleted = 'F'
+            GROUP BY o.seriesid)
+        SELECT m1.seriesid, firsttimestamp, lasttimestamp
+          , firstnumericvalue, lastnumericvalue
+        FROM (
+          SELECT mm.seriesid, obs.phenomenontimeend as firsttimestamp, value as firstnumericvalue
+          FROM sos.observation obs
+          JOIN mm
+            ON obs.seriesid = mm.seriesid
+              AND obs.phenomenontimeend = mm.d_min
+              AND obs.deleted = 'F'
+          JOIN sos.numericvalue v
+            ON v.observationid = obs.observationid
+        ) m1
+        , (
+          SELECT mm.seriesid, obs.phenomenontimeend as lasttimestamp, value as lastnumericvalue
+          FROM sos.observation obs
+          JOIN mm
+            ON obs.seriesid = mm.seriesid
+              AND obs.phenomenontimeend = mm.d_max
+              AND obs.deleted = 'F'
+          JOIN sos.numericvalue v
+            ON v.observationid = obs.observationid
+        ) m2
+        WHERE m1.seriesid = m2.seriesid
+      ) u
+    WHERE u.seriesid = s.seriesid;
+    DELETE FROM lml_import.series_dirty;
+    RETURN true;
+  END IF;
+
+  -- take the marks (marks of transactions still running stay, for the next run)
+  WITH taken AS (
+    DELETE FROM lml_import.series_dirty
+    RETURNING seriesid, mintime, removed
+  )
+  SELECT array_agg(t.seriesid), array_agg(t.mintime), array_agg(t.removed)
+    INTO dirty_ids, dirty_mintimes, dirty_removed
+    FROM (SELECT seriesid, min(mintime) AS mintime, bool_or(removed) AS removed
+      FROM taken
+      GROUP BY seriesid) t;
+
+  FOR d IN
+    SELECT sd.seriesid, sd.mintime, sd.removed, s.firsttimestamp, s.lasttimestamp
+    FROM unnest(dirty_ids, dirty_mintimes, dirty_removed) AS sd(seriesid, mintime, removed)
+    JOIN sos.series s
+      ON s.seriesid = sd.seriesid
+  LOOP
+    IF NOT d.removed AND d.firsttimestamp IS NOT NULL AND d.mintime >= d.firsttimestamp THEN
+      -- nothing before the first observation, nothing removed: only the last can change
+      SELECT o.phenomenontimeend, v.value INTO last_obs
+        FROM sos.observation o
+        JOIN sos.numericvalue v
+          ON v.observationid = o.observationid
+        WHERE o.seriesid = d.seriesid
+          AND o.deleted = 'F'
+          AND o.phenomenontimeend >= d.lasttimestamp
+        ORDER BY o.phenomenontimeend DESC
+        LIMIT 1;
+      IF FOUND THEN
+        UPDATE sos.series
+          SET lasttimestamp = last_obs.phenomenontimeend
+            , lastnumericvalue = last_obs.value
+          WHERE seriesid = d.seriesid;
+      END IF;
+    ELSE
+      -- recompute first and last of this series
+      SELECT o.phenomenontimeend, v.value INTO first_obs
+        FROM sos.observation o
+        JOIN sos.numericvalue v
+          ON v.observationid = o.observationid
+        WHERE o.seriesid = d.seriesid
+          AND o.deleted = 'F'
+        ORDER BY o.phenomenontimeend ASC
+        LIMIT 1;
+      IF FOUND THEN
+        SELECT o.phenomenontimeend, v.value INTO last_obs
+          FROM sos.observation o
+          JOIN sos.numericvalue v
+            ON v.observationid = o.observationid
+          WHERE o.seriesid = d.seriesid
+            AND o.deleted = 'F'
+          ORDER BY o.phenomenontimeend DESC
+          LIMIT 1;
+        UPDATE sos.series
+          SET firsttimestamp = first_obs.phenomenontimeend
+            , lasttimestamp = last_obs.phenomenontimeend
+            , firstnumericvalue = first_obs.value
+            , lastnumericvalue = last_obs.value
+          WHERE seriesid = d.seriesid;
+      ELSE
+        -- no observations left
+        UPDATE sos.series
+          SET firsttimestamp = NULL
+            , lasttimestamp = NULL
+            , firstnumericvalue = NULL
+            , lastnumericvalue = NULL
+          WHERE seriesid = d.seriesid;
+      END IF;
+    END IF;
+  END LOOP;
+  RETURN true;
+END;
+$$;
+
+
+--
+-- Name: download_failures; Type: TABLE; Schema: lml_import; Owner: -
+-- Retry bookkeeping per file: number of attempts, last attempt and its result, and
+-- the next attempt (exponential backoff). Status GIVEUP: no more retries.
+--
+
+ALTER TABLE download_failures ADD COLUMN IF NOT EXISTS attempts integer DEFAULT 1 NOT NULL;
+
+ALTER TABLE download_failures ADD COLUMN IF NOT EXISTS ts_lastattempt timestamp with time zone;
+
+ALTER TABLE download_failures ADD COLUMN IF NOT EXISTS last_status character varying(64);
+
+ALTER TABLE download_failures ADD COLUMN IF NOT EXISTS ts_nextattempt timestamp with time zone;
+
+UPDATE download_failures
+  SET ts_lastattempt = ts_created
+    , ts_nextattempt = ts_created
+  WHERE ts_nextattempt IS NULL;
+
+
+--
+-- Name: download_failures_insert(); Type: FUNCTION; Schema: lml_import; Owner: -
+-- A failure of a file that failed before is counted (attempts), and its next attempt
+-- is postponed: lml.retry.backoff minutes, doubled with every attempt, at most
+-- lml.retry.maxbackoff hours. After lml.retry.maxattempts attempts (0: no limit) the
+-- status becomes GIVEUP.
+--
+
+CREATE OR REPLACE FUNCTION download_failures_insert() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+  backoff interval;
+  max_backoff interval;
+  max_attempts integer;
+BEGIN
+  backoff := coalesce((SELECT configvalue FROM lml_import.configuration WHERE key = 'lml.retry.backoff'), '15') || ' minutes';
+  max_backoff := coalesce((SELECT configvalue FROM lml_import.configuration WHERE key = 'lml.retry.maxbackoff'), '24') || ' hours';
+  max_attempts := coalesce((SELECT configvalue FROM lml_import.configuration WHERE key = 'lml.retry.maxattempts'), '0');
+
+  UPDATE lml_import.download_failures f
+    SET attempts = f.attempts + 1
+      , ts_lastattempt = now()
+      , last_status = NEW.last_status
+      , ts_nextattempt = now() + least(backoff * power(2, least(f.attempts, 20)), max_backoff)
+      , status = CASE WHEN max_attempts > 0 AND f.attempts + 1 >= max_attempts THEN 'GIVEUP' ELSE f.status END
+    WHERE f.filename = NEW.filename;
+  IF FOUND THEN
+    RETURN NULL;
+  ELSE
+    NEW.attempts := 1;
+    NEW.ts_lastattempt := now();
+    NEW.ts_nextattempt := now() + least(backoff, max_backoff);
+    RETURN NEW;
+  END IF;
+END;
+$$;
+
+
+--
+-- Name: lookup indexes; Type: INDEX; Schema: lml_import; Owner: -
+-- xmlfilename (xml_files), filename (download_failures) and key (uribase) become unique
+-- keys, existing duplicates are removed first (only once, when the index is created).
+-- A uribase key with different uris is not guessed at: the upgrade stops, before the
+-- index, with the keys to correct.
+--
+
+DO $$
+DECLARE
+  dupkeys text;
+BEGIN
+  IF NOT EXISTS (SELECT 1 FROM pg_indexes WHERE schemaname = 'lml_import' AND indexname = 'xml_files_xmlfilename_key') THEN
+    DELETE FROM lml_import.xml_files a
+      USING lml_import.xml_files b
+      WHERE a.xmlfilename = b.xmlfilename
+        AND a.id < b.id;
+    CREATE UNIQUE INDEX xml_files_xmlfilename_key ON lml_import.xml_files USING btree (xmlfilename);
+  END IF;
+  IF NOT EXISTS (SELECT 1 FROM pg_indexes WHERE schemaname = 'lml_import' AND indexname = 'download_failures_filename_key') THEN
+    DELETE FROM lml_import.download_failures a
+      USING lml_import.download_failures b
+      WHERE a.filename = b.filename
+        AND a.id > b.id;
+    CREATE UNIQUE INDEX download_failures_filename_key ON lml_import.download_failures USING btree (filename);
+  END IF;
+  IF NOT EXISTS (SELECT 1 FROM pg_indexes WHERE schemaname = 'lml_import' AND indexname = 'uribase_key_key') THEN
+    SELECT string_agg(DISTINCT a.key, ', ') INTO dupkeys
+      FROM lml_import.uribase a
+      JOIN lml_import.uribase b
+        ON a.key = b.key
+        AND a.id < b.id
+        AND a.uri IS DISTINCT FROM b.uri;
+    IF dupkeys IS NOT NULL THEN
+      RAISE EXCEPTION 'uribase has different uris for the key(s) %', dupkeys
+        USING HINT = 'Keep one row per key in lml_import.uribase, then load lml_import-upgrade.sql again.';
+    END IF;
+    DELETE FROM lml_import.uribase a
+      USING lml_import.uribase b
+      WHERE a.key = b.key
+        AND a.id > b.id;
+    CREATE UNIQUE INDEX uribase_key_key ON lml_import.uribase USING btree (key);
+  END IF;
+END;
+$$;
+
+CREATE INDEX IF NOT EXISTS measurements_xmlfilename_idx ON measurements USING btree (xmlfilename);
+
+DROP INDEX IF EXISTS download_failures_retry_idx;
+
+CREATE INDEX IF NOT EXISTS download_failures_due_idx ON download_failures USING btree (ts_nextattempt) WHERE ((status)::text = 'RETRY'::text);
+
+CREATE INDEX IF NOT EXISTS xml_files_toprocess_idx ON xml_files USING btree (id) WHERE ((ts_processed IS NULL) OR (ts_updated > ts_processed));
+
+
+
+--
+-- Name: sos lookup indexes; Type: INDEX; Schema: sos; Owner: -
+-- Series by foi/observableproperty/procedure (getseriesid) and observations by series
+-- and time (updateseries). Only created when the SOS schema does not have them already.
+--
+
+DO $$
+BEGIN
+  IF to_regclass('sos.series') IS NOT NULL AND NOT EXISTS (SELECT 1 FROM pg_indexes WHERE schemaname = 'sos' AND tablename = 'series'
+      AND indexdef LIKE '%(featureofinterestid, observablepropertyid, procedureid)%') THEN
+    CREATE INDEX lml_series_identity_idx ON sos.series USING btree (featureofinterestid, observablepropertyid, procedureid);
+  END IF;
+  IF to_regclass('sos.observation') IS NOT NULL AND NOT EXISTS (SELECT 1 FROM pg_indexes WHERE schemaname = 'sos' AND tablename = 'observation'
+      AND indexdef LIKE '%(seriesid, phenomenontimeend)%') THEN
+    CREATE INDEX lml_observation_series_time_idx ON sos.observation USING btree (seriesid, phenomenontimeend);
+  END IF;
+END;
+$$;
+
+
+--
+-- Name: vw_download_failures; Type: VIEW; Schema: lml_import; Owner: -
+-- NOT EXISTS instead of NOT IN, uses the xmlfilename key.
+--
+
+CREATE OR REPLACE VIEW vw_download_failures AS
+    SELECT download_status.id, download_status.filename FROM download_failures download_status WHERE ((NOT (EXISTS (SELECT 1 FROM xml_files WHERE ((xml_files.xmlfilename)::text = (download_status.filename)::text)))) AND ((download_status.status)::text = 'RETRY'::text));
+
+
+--
+-- Name: publish_targets; Type: TABLE; Schema: lml_import; Owner: -
+-- Cache of the publishing metadata per statsensunit: sos identifiers (uris) and the
+-- resolved sos ids. Refreshed by lml-prepare.py and by triggers on the configuration
+-- tables (refresh_publish_targets).
+--
+
+CREATE TABLE IF NOT EXISTS publish_targets (
+    statsensunit_id bigint NOT NULL PRIMARY KEY,
+    station_id bigint,
+    sensorcode text,
+    publishstationcode text,
+    m_unit text,
+    publish_sos boolean,
+    geom public.geometry,
+    procedure_uri text,
+    featureofinterest_uri text,
+    observableproperty_uri text,
+    offering_uri text,
+    observation_uri text,
+    series_id bigint,
+    offering_id bigint,
+    codespace_id bigint,
+    unit_id bigint,
+    ts_refreshed timestamp with time zone
+);
+
+CREATE INDEX IF NOT EXISTS publish_targets_station_sensor_idx ON publish_targets USING btree (station_id, sensorcode);
+
+CREATE INDEX IF NOT EXISTS publish_targets_publishstation_sensor_idx ON publish_targets USING btree (publishstationcode, sensorcode);
+
+
+--
+-- Name: refresh_publish_targets(bigint[]); Type: FUNCTION; Schema: lml_import; Owner: -
+-- Brings publish_targets up to date, for the given statsensunit ids or all (null).
+-- Only targets that changed are written (ts_refreshed: last change), so there is no
+-- table lock: concurrent refreshes (workers, publishing in a batch) only wait for each
+-- other on the same changed targets, and a target that is still unresolved (SOS not
+-- prepared) is not locked at all. Returns the number of targets checked.
+-- Replaces refresh_publish_targets(bigint).
+--
+
+DROP FUNCTION IF EXISTS refresh_publish_targets(bigint);
+
+CREATE OR REPLACE FUNCTION refresh_publish_targets(ssu_ids bigint[] DEFAULT NULL) RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+  n integer;
+BEGIN
+  WITH ub AS (
+    -- the various uri-bases
+    SELECT (SELECT uri FROM lml_import.uribase WHERE key = 'procedure') AS ub_sensor
+      , (SELECT uri FROM lml_import.uribase WHERE key = 'featureofinterest') AS ub_foi
+      , (SELECT uri FROM lml_import.uribase WHERE key = 'observableproperty') AS ub_obsprop
+      , (SELECT uri FROM lml_import.uribase WHERE key = 'offering') AS ub_offer
+      , (SELECT uri FROM lml_import.uribase WHERE key = 'observation') AS ub_obs
+  ), t AS (
+    SELECT s.id, s.station_id, s.sensorcode, s.publishstationcode, s.m_unit, s.publish_sos, s.geom
+      , ub_sensor || s.publishstationcode || '/' || s.sensorcode AS procedure_uri
+      , ub_foi || s.publishstationcode AS featureofinterest_uri
+      , ub_obsprop || s.sensorcode AS observableproperty_uri
+      , ub_offer || s.publishstationcode || '/' || s.sensorcode AS offering_uri
+      , ub_obs || s.publishstationcode || '/' || s.sensorcode || '/' AS observation_uri
+    FROM lml_import.vw_statsensunit s, ub
+    WHERE ssu_ids IS NULL OR s.id = ANY(ssu_ids)
+  ), target AS (
+    -- the targets as they should be
+    SELECT t.*
+      , lml_import.getseriesid(t.featureofinterest_uri, t.observableproperty_uri, t.procedure_uri) AS series_id
+      , (SELECT offeringid FROM sos.offering WHERE identifier = t.offering_uri) AS offering_id
+      , (SELECT codespaceid FROM sos.codespace WHERE codespace = 'http://www.opengis.net/def/nil/OGC/0/unknown') AS codespace_id
+      , (SELECT unitid FROM sos.unit WHERE unit = t.m_unit) AS unit_id
+    FROM t
+  ), upd AS (
+    UPDATE lml_import.publish_targets p
+      SET station_id = n.station_id, sensorcode = n.sensorcode, publishstationcode = n.publishstationcode
+        , m_unit = n.m_unit, publish_sos = n.publish_sos, geom = n.geom
+        , procedure_uri = n.procedure_uri, featureofinterest_uri = n.featureofinterest_uri
+        , observableproperty_uri = n.observableproperty_uri, offering_uri = n.offering_uri, observation_uri = n.observation_uri
+        , series_id = n.series_id, offering_id = n.offering_id, codespace_id = n.codespace_id, unit_id = n.unit_id
+        , ts_refreshed = now()
+      FROM target n
+      WHERE p.statsensunit_id = n.id
+        AND (p.station_id, p.sensorcode, p.publishstationcode, p.m_unit, p.publish_sos, p.geom
+          , p.procedure_uri, p.featureofinterest_uri, p.observableproperty_uri, p.offering_uri, p.observation_uri
+          , p.series_id, p.offering_id, p.codespace_id, p.unit_id)
+        IS DISTINCT FROM (n.station_id, n.sensorcode, n.publishstationcode, n.m_unit, n.publish_sos, n.geom
+          , n.procedure_uri, n.featureofinterest_uri, n.observableproperty_uri, n.offering_uri, n.observation_uri
+          , n.series_id, n.offering_id, n.codespace_id, n.unit_id)
+  ), ins AS (
+    INSERT INTO lml_import.publish_targets (
+                statsensunit_id, station_id, sensorcode, publishstationcode, m_unit, publish_sos, geom,
+                procedure_uri, featureofinterest_uri, observableproperty_uri, offering_uri, observation_uri,
+                series_id, offering_id, codespace_id, unit_id, ts_refreshed)
+      SELECT n.*, now()
+      FROM target n
+      WHERE NOT EXISTS (SELECT 1 FROM lml_import.publish_targets p WHERE p.statsensunit_id = n.id)
+      ON CONFLICT (statsensunit_id) DO NOTHING
+  ), del AS (
+    -- statsensunit rows that are gone
+    DELETE FROM lml_import.publish_targets p
+      WHERE (ssu_ids IS NULL OR p.statsensunit_id = ANY(ssu_ids))
+        AND NOT EXISTS (SELECT 1 FROM t WHERE t.id = p.statsensunit_id)
+  )
+  SELECT count(*) INTO n FROM target;
+
+  RETURN n;
+END;
+$$;
+
+
+--
+-- Name: publish_targets_pending; Type: TABLE; Schema: lml_import; Owner: -
+-- statsensunit ids whose publish targets changed in the current statement, refreshed
+-- by publish_targets_refresh() at the end of the statement.
+--
+
+CREATE TABLE IF NOT EXISTS publish_targets_pending (
+    statsensunit_id bigint NOT NULL PRIMARY KEY
+);
+
+
+--
+-- Name: publish_targets_mark(); Type: FUNCTION; Schema: lml_import; Owner: -
+-- Row trigger of statsensunit, sensors, stations_eionet and units: collects the
+-- statsensunit ids of the changed row (old and new values).
+--
+
+CREATE OR REPLACE FUNCTION publish_targets_mark() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+  row_ids bigint[] := '{}';
+BEGIN
+  IF TG_OP <> 'INSERT' THEN
+    row_ids := row_ids || OLD.id;
+  END IF;
+  IF TG_OP <> 'DELETE' THEN
+    row_ids := row_ids || NEW.id;
+  END IF;
+
+  IF TG_TABLE_NAME = 'statsensunit' THEN
+    INSERT INTO lml_import.publish_targets_pending (statsensunit_id)
+      SELECT DISTINCT unnest(row_ids)
+      ON CONFLICT DO NOTHING;
+  ELSE
+    INSERT INTO lml_import.publish_targets_pending (statsensunit_id)
+      SELECT s.id
+      FROM lml_import.statsensunit s
+      WHERE CASE TG_TABLE_NAME
+          WHEN 'sensors' THEN s.sensor_id
+          WHEN 'stations_eionet' THEN s.station_id
+          ELSE s.unit_id
+        END = ANY(row_ids)
+      ON CONFLICT DO NOTHING;
+  END IF;
+  RETURN NULL;
+END;
+$$;
+
+
+--
+-- Name: publish_targets_refresh(); Type: FUNCTION; Schema: lml_import; Owner: -
+-- Statement trigger: refreshes the targets collected by publish_targets_mark(), all
+-- targets after a change of uribase or a truncate. Nothing is resolved before the sos
+-- schema exists (configuration loaded before the SOS), lml-prepare.py fills the table.
+--
+
+CREATE OR REPLACE FUNCTION publish_targets_refresh() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+  ssu_ids bigint[];
+BEGIN
+  WITH taken AS (
+    DELETE FROM lml_import.publish_targets_pending
+    RETURNING statsensunit_id
+  )
+  SELECT array_agg(statsensunit_id) INTO ssu_ids FROM taken;
+
+  IF to_regclass('sos.series') IS NULL THEN
+    RETURN NULL;
+  END IF;
+  IF TG_OP = 'TRUNCATE' OR TG_TABLE_NAME = 'uribase' THEN
+    PERFORM lml_import.refresh_publish_targets();
+  ELSIF cardinality(ssu_ids) > 0 THEN
+    PERFORM lml_import.refresh_publish_targets(ssu_ids);
+  END IF;
+  RETURN NULL;
+END;
+$$;
+
+
+--
+-- Name: *_publish_targets; Type: TRIGGER; Schema: lml_import; Owner: -
+--
+
+DROP TRIGGER IF EXISTS statsensunit_publish_targets ON statsensunit;
+
+CREATE TRIGGER statsensunit_publish_targets AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON statsensunit FOR EACH STATEMENT EXECUTE PROCEDURE publish_targets_refresh();
+
+DROP TRIGGER IF EXISTS statsensunit_publish_targets_mark ON statsensunit;
+
+CREATE TRIGGER statsensunit_publish_targets_mark AFTER INSERT OR UPDATE OR DELETE ON statsensunit FOR EACH ROW EXECUTE PROCEDURE publish_targets_mark();
+
+DROP TRIGGER IF EXISTS uribase_publish_targets ON uribase;
+
+CREATE TRIGGER uribase_publish_targets AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON uribase FOR EACH STATEMENT EXECUTE PROCEDURE publish_targets_refresh();
+
+DROP TRIGGER IF EXISTS units_publish_targets ON units;
+
+CREATE TRIGGER units_publish_targets AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON units FOR EACH STATEMENT EXECUTE PROCEDURE publish_targets_refresh();
+
+DROP TRIGGER IF EXISTS units_publish_targets_mark ON units;
+
+CREATE TRIGGER units_publish_targets_mark AFTER INSERT OR UPDATE OR DELETE ON units FOR EACH ROW EXECUTE PROCEDURE publish_targets_mark();
+
+DROP TRIGGER IF EXISTS sensors_publish_targets ON sensors;
+
+CREATE TRIGGER sensors_publish_targets AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON sensors FOR EACH STATEMENT EXECUTE PROCEDURE publish_targets_refresh();
+
+DROP TRIGGER IF EXISTS sensors_publish_targets_mark ON sensors;
+
+CREATE TRIGGER sensors_publish_targets_mark AFTER INSERT OR UPDATE OR DELETE ON sensors FOR EACH ROW EXECUTE PROCEDURE publish_targets_mark();
+
+DROP TRIGGER IF EXISTS stations_eionet_publish_targets ON stations_eionet;
+
+CREATE TRIGGER stations_eionet_publish_targets AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON stations_eionet FOR EACH STATEMENT EXECUTE PROCEDURE publish_targets_refresh();
+
+DROP TRIGGER IF EXISTS stations_eionet_publish_targets_mark ON stations_eionet;
+
+CREATE TRIGGER stations_eionet_publish_targets_mark AFTER INSERT OR UPDATE OR DELETE ON stations_eionet FOR EACH ROW EXECUTE PROCEDURE publish_targets_mark();
+
+
+--
+-- Name: get_publish_target(text, text); Type: FUNCTION; Schema: lml_import; Owner: -
+--
+
+CREATE OR REPLACE FUNCTION get_publish_target(publishstatcode text, sensor_code text) RETURNS lml_import.publish_targets
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+  t lml_import.publish_targets%ROWTYPE;
+BEGIN
+  SELECT * INTO t
+    FROM lml_import.publish_targets p
+    WHERE p.publishstationcode = publishstatcode
+      AND p.sensorcode = sensor_code
+    ORDER BY p.statsensunit_id
+    LIMIT 1;
+  IF NOT FOUND THEN
+    RAISE EXCEPTION 'Station/sensor %/% is not configured in statsensunit', publishstatcode, sensor_code;
+  END IF;
+  RETURN t;
+END;
+$$;
+
+
+--
+-- Name: publish_observation(publish_targets, bigint, bigint, public.geometry, double precision, text, timestamp with time zone, timestamp with time zone, timestamp with time zone); Type: FUNCTION; Schema: lml_import; Owner: -
+-- Writes one observation to the three sos tables, all ids from publish_targets.
+--
+
+CREATE OR REPLACE FUNCTION publish_observation(t lml_import.publish_targets, obsid bigint, mseriesid bigint, statgeom public.geometry, mvalue double precision, munit text, timestart timestamp with time zone, timeend timestamp with time zone, result_time timestamp with time zone) RETURNS bigint
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+  unit_id bigint;
+BEGIN
+  -- resolve again when the SOS was not (fully) prepared at the last refresh
+  IF t.series_id IS NULL OR t.offering_id IS NULL THEN
+    PERFORM lml_import.refresh_publish_targets(ARRAY[t.statsensunit_id]);
+    SELECT * INTO t FROM lml_import.publish_targets p WHERE p.statsensunit_id = t.statsensunit_id;
+  END IF;
+
+  -- the unit is usually the configured unit
+  IF munit = t.m_unit THEN
+    unit_id := t.unit_id;
+  ELSE
+    SELECT unitid INTO unit_id
+      FROM sos.unit
+      WHERE unit = munit;
+  END IF;
+
+  -- insert the observation
+  INSERT INTO sos.observation(
+            observationid, seriesid, phenomenontimestart, phenomenontimeend,
+            resulttime, identifier, codespaceid, deleted, unitid, samplinggeometry)
+    VALUES (obsid, t.series_id
+            , timestart::timestamp with time zone AT TIME ZONE 'UTC'
+            , timeend::timestamp with time zone AT TIME ZONE 'UTC'
+            , result_time::timestamp with time zone AT TIME ZONE 'UTC'
+            , t.observation_uri || mseriesid::text
+            , t.codespace_id
+            , 'F'
+            , unit_id
+            , statgeom)
+  ;
+
+  -- insert the measured value
+  INSERT INTO sos.numericvalue (observationid, value)
+    VALUES(obsid, mvalue);
+
+  -- insert the link to the offering
+  INSERT INTO sos.observationhasoffering (observationid, offeringid)
+    VALUES(obsid, t.offering_id);
+
+  -- series metadata to update (updateseries)
+  PERFORM lml_import.mark_series_dirty(t.series_id, timeend AT TIME ZONE 'UTC', false);
+
+  -- return observation identification
+  RETURN obsid;
+END;
+$$;
+
+
+--
+-- Name: insertobservation(bigint, text, text, double precision, text, timestamp with time zone, timestamp with time zone, timestamp with time zone); Type: FUNCTION; Schema: lml_import; Owner: -
+--
+
+CREATE OR REPLACE FUNCTION insertobservation(mseriesid bigint, publishstatcode text, sensorcode text, mvalue double precision, munit text, timestart timestamp with time zone, timeend timestamp with time zone, result_time timestamp with time zone) RETURNS bigint
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+  RETURN lml_import.publish_observation(
+    lml_import.get_publish_target(publishstatcode, sensorcode)
+    , nextval('sos.observationid_seq'::regclass)
+    , mseriesid, NULL, mvalue, munit, timestart, timeend, result_time);
+END;
+$$;
+
+
+--
+-- Name: insertobservation(bigint, text, public.geometry, text, double precision, text, timestamp with time zone, timestamp with time zone, timestamp with time zone); Type: FUNCTION; Schema: lml_import; Owner: -
+--
+
+CREATE OR REPLACE FUNCTION insertobservation(mseriesid bigint, publishstatcode text, statgeom public.geometry, sensorcode text, mvalue double precision, munit text, timestart timestamp with time zone, timeend timestamp with time zone, result_time timestamp with time zone) RETURNS bigint
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+  RETURN lml_import.publish_observation(
+    lml_import.get_publish_target(publishstatcode, sensorcode)
+    , nextval('sos.observationid_seq'::regclass)
+    , mseriesid, statgeom, mvalue, munit, timestart, timeend, result_time);
+END;
+$$;
+
+
+--
+-- Name: restoreobservation(bigint, bigint, text, text, double precision, text, timestamp with time zone, timestamp with time zone, timestamp with time zone); Type: FUNCTION; Schema: lml_import; Owner: -
+--
+
+CREATE OR REPLACE FUNCTION restoreobservation(obsid bigint, mseriesid bigint, publishstatcode text, sensorcode text, mvalue double precision, munit text, timestart timestamp with time zone, timeend timestamp with time zone, result_time timestamp with time zone) RETURNS bigint
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+  RETURN lml_import.publish_observation(
+    lml_import.get_publish_target(publishstatcode, sensorcode)
+    , obsid
+    , mseriesid, NULL, mvalue, munit, timestart, timeend, result_time);
+END;
+$$;
+
+
+--
+-- Name: restoreobservation(bigint, bigint, text, public.geometry, text, double precision, text, timestamp with time zone, timestamp with time zone, timestamp with time zone); Type: FUNCTION; Schema: lml_import; Owner: -
+--
+
+CREATE OR REPLACE FUNCTION restoreobservation(obsid bigint, mseriesid bigint, publishstatcode text, statgeom public.geometry, sensorcode text, mvalue double precision, munit text, timestart timestamp with time zone, timeend timestamp with time zone, result_time timestamp with time zone) RETURNS bigint
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+  RETURN lml_import.publish_observation(
+    lml_import.get_publish_target(publishstatcode, sensorcode)
+    , obsid
+    , mseriesid, statgeom, mvalue, munit, timestart, timeend, result_time);
+END;
+$$;
+
+
+--
+-- Name: publish_targets; Type: TABLE DATA; Schema: lml_import; Owner: -
+-- Initial fill (when the sos schema is present).
+--
+
+DO $$
+BEGIN
+  IF to_regclass('sos.series') IS NOT NULL THEN
+    PERFORM lml_import.refresh_publish_targets();
+  END IF;
+END;
+$$;
+
+
+--
+-- Name: process_sensor_tpl_all(text, text); Type: FUNCTION; Schema: lml_import; Owner: -
+-- SensorML of all active station/sensor combinations to publish, in one call: template
+-- and uri-bases are read once (see process_sensor_tpl for a single sensor). The output
+-- name is <sensorcode>_value.
+--
+
+CREATE OR REPLACE FUNCTION process_sensor_tpl_all(tplname text, sensorinputcode text) RETURNS TABLE(statsensunit_id bigint, publishstationcode text, sensorcode text, name text, municipality text, m_unit text, sensorml text)
+    LANGUAGE plpgsql
+    AS $_$
+DECLARE
+  tpl_contents text;
+  tpl text;
+  stat record;
+  ub_sensor text;
+  ub_foi text;
+  ub_obsprop text;
+  ub_offer text;
+BEGIN
+  -- get the template
+  SELECT contents INTO tpl_contents FROM lml_import.templates WHERE templatename = tplname;
+  -- get the various uri-bases
+  SELECT uri INTO ub_sensor FROM lml_import.uribase WHERE key = 'procedure';
+  SELECT uri INTO ub_foi FROM lml_import.uribase WHERE key = 'featureofinterest';
+  SELECT uri INTO ub_obsprop FROM lml_import.uribase WHERE key = 'observableproperty';
+  SELECT uri INTO ub_offer FROM lml_import.uribase WHERE key = 'offering';
+
+  FOR stat IN
+    SELECT s.*
+      , st_x(st_transform(s.geom, 4326))::text AS easting
+      , st_y(st_transform(s.geom, 4326))::text AS northing
+    FROM lml_import.vw_statsensunit s
+    WHERE s.publish_sos = true
+      AND s.activityend IS NULL
+    ORDER BY s.publishstationcode, s.sensorcode, s.id
+  LOOP
+    -- replace/insert values
+    -- procedure id
+    tpl := replace(tpl_contents, '$sensor.id$', ub_sensor || stat.publishstationcode || '/' || stat.sensorcode);
+    tpl := replace(tpl, '$sensor.longname$', stat.namespace || ' (' || stat.sensorcode || ') ' || trim(stat.name || ' ' || stat.municipality));
+    tpl := replace(tpl, '$sensor.shortname$', stat.name || ' (' || stat.sensorcode || ')');
+
+    -- offering
+    tpl := replace(tpl, '$sensor.offering.name$', 'Offering for: ' || stat.name || ' (' || stat.sensorcode || ')');
+    tpl := replace(tpl, '$sensor.offering.id$', ub_offer || stat.publishstationcode || '/' || stat.sensorcode);
+
+    -- parentproc
+    tpl := replace(tpl, '$sensor.parent.id$', ub_sensor || stat.sensorcode);
+
+    -- feat of interest
+    tpl := replace(tpl, '$sensor.featureofinterest.id$', ub_foi || stat.publishstationcode);
+
+    -- position
+    tpl := replace(tpl, '$sensor.pos.gmlid$', stat.gmlid);
+    tpl := replace(tpl, '$sensor.pos.easting$', stat.easting);
+    tpl := replace(tpl, '$sensor.pos.northing$', stat.northing);
+    tpl := replace(tpl, '$sensor.pos.altitudeunit$', stat.altitudeunit::text);
+    tpl := replace(tpl, '$sensor.pos.altitude$', stat.altitude::text);
+
+    -- input/output
+    tpl := replace(tpl, '$sensor.input.name$', sensorinputcode);
+    tpl := replace(tpl, '$sensor.observableproperty.input.id$', ub_obsprop || sensorinputcode);
+    tpl := replace(tpl, '$sensor.output.name$', stat.sensorcode || '_value');
+    tpl := replace(tpl, '$sensor.observableproperty.output.id$', ub_obsprop || stat.sensorcode);
+
+    -- unit
+    tpl := replace(tpl, '$observation.unit$', stat.m_unit);
+
+    statsensunit_id := stat.id;
+    publishstationcode := stat.publishstationcode;
+    sensorcode := stat.sensorcode;
+    name := stat.name;
+    municipality := stat.municipality;
+    m_unit := stat.m_unit;
+    sensorml := tpl;
+    RETURN NEXT;
+  END LOOP;
+END;
+$_$;
+
+
+--
+-- Name: sensor_fingerprints; Type: TABLE; Schema: lml_import; Owner: -
+-- md5 of the SensorML last accepted by the SOS, per procedure (lml-prepare.py reconcile).
+--
+
+CREATE TABLE IF NOT EXISTS sensor_fingerprints (
+    procedure_identifier text NOT NULL PRIMARY KEY,
+    sensorml_md5 text,
+    ts_pushed timestamp with time zone
+);
+
+
+--
+-- Name: templates; Type: TABLE DATA; Schema: lml_import; Owner: -
+-- UpdateSensorDescription (lml-prepare.py reconcile) for installations configured before
+-- it was in lml_import-config-example.dat. Empty template tables (new installations,
+-- the example data is loaded after this script) are left alone.
+--
+
+DO $$
+BEGIN
+  IF EXISTS (SELECT 1 FROM lml_import.templates)
+      AND NOT EXISTS (SELECT 1 FROM lml_import.templates WHERE templatename = 'UpdateSensorDescription') THEN
+    INSERT INTO lml_import.templates (id, templatename, templatetype, contents)
+      SELECT max(id) + 1, 'UpdateSensorDescription', 'JSON'
+        , E'{\r  "request": "UpdateSensorDescription",\r  "service": "SOS",\r  "version": "2.0.0",\r  "procedure": "$sensor.id$",\r  "procedureDescriptionFormat": "http://www.opengis.net/sensorML/1.0.1",\r  "procedureDescription": "$procedure.sensorml$"\r}'
+      FROM lml_import.templates;
+    PERFORM setval('lml_import.templates_id_seq', (SELECT max(id) FROM lml_import.templates));
+  END IF;
+END;
+$$;
+
+
+--
+-- Name: backfill_days; Type: TABLE; Schema: lml_import; Owner: -
+-- Days completed by lml-retrieve.py backfill (checkpoints, an interrupted backfill
+-- resumes with the first day not in this table).
+--
+
+CREATE TABLE IF NOT EXISTS backfill_days (
+    day date NOT NULL PRIMARY KEY,
+    files integer,
+    observations bigint,
+    ts_done timestamp with time zone
+);
+
+
+--
+-- Name: measurements_enddatetime_idx; Type: INDEX; Schema: lml_import; Owner: -
+--
+
+CREATE INDEX IF NOT EXISTS measurements_enddatetime_idx ON measurements USING btree (enddatetime);
+
+
+--
+-- Name: restore_sos(timestamp with time zone, timestamp with time zone, text[], text[], boolean); Type: FUNCTION; Schema: lml_import; Owner: -
+-- Set based restoreobservation for the measurements of a time range (enddatetime,
+-- [time_from, time_to>), optionally only some stations (publishstationcode) and sensors.
+-- Restore (new_ids false): the measurements missing in the sos tables are published with
+-- their original sos_observationid (a new one if they have none), e.g. after a rebuild
+-- of the SOS database.
+-- Republish (new_ids true): all measurements get a new sos_observationid (one sequence
+-- batch), the current observations are removed. Use it after a change of the uribase.
+-- Stations/sensors that are not prepared in the SOS are skipped and logged in message_log
+-- (SOSRestore, ERROR). Returns the number of published observations.
+--
+
+CREATE OR REPLACE FUNCTION restore_sos(time_from timestamp with time zone, time_to timestamp with time zone, publishstatcodes text[] DEFAULT NULL, sensorcodes text[] DEFAULT NULL, new_ids boolean DEFAULT false) RETURNS bigint
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+  -- result: number of published observations
+  n bigint;
+  max_id bigint;
+  unresolved bigint[];
+BEGIN
+  -- resolve again the targets that were not (fully) known in the SOS at the last refresh
+  unresolved := ARRAY(SELECT p.statsensunit_id
+    FROM lml_import.publish_targets p
+    WHERE p.publish_sos = true
+      AND (publishstatcodes IS NULL OR p.publishstationcode = ANY(publishstatcodes))
+      AND (sensorcodes IS NULL OR p.sensorcode = ANY(sensorcodes))
+      AND (p.series_id IS NULL OR p.offering_id IS NULL));
+  IF cardinality(unresolved) > 0 THEN
+    PERFORM lml_import.refresh_publish_targets(unresolved);
+  END IF;
+
+  CREATE TEMPORARY TABLE restore_todo (
+      id bigint,
+      old_id bigint,
+      obs_id bigint,
+      series_id bigint,
+      offering_id bigint,
+      unit_id bigint,
+      codespace_id bigint,
+      geom public.geometry,
+      obs_uri text,
+      m_value double precision,
+      begindatetime timestamp with time zone,
+      enddatetime timestamp with time zone
+  ) ON COMMIT DROP;
+
+  CREATE TEMPORARY TABLE restore_targets ON COMMIT DROP AS
+    -- station, sensor, unit to publish (same selection as publish_sos: first match)
+    SELECT DISTINCT ON (p.station_id, p.sensorcode) p.*
+    FROM lml_import.publish_targets p
+    WHERE p.publish_sos = true
+      AND (publishstatcodes IS NULL OR p.publishstationcode = ANY(publishstatcodes))
+      AND (sensorcodes IS NULL OR p.sensorcode = ANY(sensorcodes))
+    ORDER BY p.station_id, p.sensorcode, p.statsensunit_id;
+
+  -- stations/sensors not (yet) prepared in the SOS: not published, logged
+  INSERT INTO lml_import.message_log (msgtimestamp, operation, filename, msglevel, msg, ts_created)
+    SELECT clock_timestamp(), 'SOSRestore', '*', 'ERROR'
+      , format('Station/sensor %s/%s is not prepared in the SOS, %s measurements not published', t.publishstationcode, t.sensorcode, count(*))
+      , now()
+    FROM lml_import.measurements m
+    JOIN pg_temp.restore_targets t
+      ON t.station_id = m.station_id
+      AND t.sensorcode = m.sensorcode
+    WHERE m.enddatetime >= time_from
+      AND m.enddatetime < time_to
+      AND (m.m_value < -900) IS NOT TRUE
+      AND (t.series_id IS NULL OR t.offering_id IS NULL)
+    GROUP BY t.publishstationcode, t.sensorcode;
+
+  INSERT INTO pg_temp.restore_todo
+    -- omit the typical nodata values, and (restore) observations that are still present
+    SELECT m.id, m.sos_observationid, m.sos_observationid
+      , t.series_id, t.offering_id, t.unit_id, t.codespace_id, t.geom
+      , t.observation_uri || m.id::text
+      , m.m_value, m.begindatetime, m.enddatetime
+    FROM lml_import.measurements m
+    JOIN pg_temp.restore_targets t
+      ON t.station_id = m.station_id
+      AND t.sensorcode = m.sensorcode
+    WHERE m.enddatetime >= time_from
+      AND m.enddatetime < time_to
+      AND (m.m_value < -900) IS NOT TRUE
+      AND t.series_id IS NOT NULL
+      AND t.offering_id IS NOT NULL
+      AND (new_ids
+        OR m.sos_observationid IS NULL
+        OR NOT EXISTS (SELECT 1 FROM sos.observation o WHERE o.observationid = m.sos_observationid));
+
+  IF new_ids THEN
+    -- republish: the current observations are replaced
+    DELETE FROM sos.numericvalue v
+      USING pg_temp.restore_todo r
+      WHERE v.observationid = r.old_id
+    ;
+    DELETE FROM sos.observationhasoffering o
+      USING pg_temp.restore_todo r
+      WHERE o.observationid = r.old_id
+    ;
+    WITH obs AS (
+      DELETE FROM sos.observation o
+        USING pg_temp.restore_todo r
+        WHERE o.observationid = r.old_id
+        RETURNING o.seriesid, o.phenomenontimeend
+    )
+    -- series metadata to update (updateseries)
+    INSERT INTO lml_import.series_dirty (seriesid, mintime, removed, ts_created)
+      SELECT seriesid, min(phenomenontimeend), true, now()
+      FROM obs
+      GROUP BY seriesid;
+  END IF;
+
+  -- the sequence must be past the original ids (it may have been reset with the SOS database)
+  SELECT max(old_id) INTO max_id FROM pg_temp.restore_todo;
+  IF max_id > (SELECT last_value FROM sos.observationid_seq) THEN
+    PERFORM setval('sos.observationid_seq'::regclass, max_id);
+  END IF;
+
+  -- new ids in one batch
+  UPDATE pg_temp.restore_todo
+    SET obs_id = nextval('sos.observationid_seq'::regclass)
+    WHERE new_ids OR obs_id IS NULL;
+
+  WITH obs AS (
+    -- insert the observations
+    INSERT INTO sos.observation(
+              observationid, seriesid, phenomenontimestart, phenomenontimeend,
+              resulttime, identifier, codespaceid, deleted, unitid, samplinggeometry)
+      SELECT obs_id, series_id
+        , begindatetime AT TIME ZONE 'UTC'
+        , enddatetime AT TIME ZONE 'UTC'
+        , now() AT TIME ZONE 'UTC'
+        , obs_uri
+        , codespace_id
+        , 'F'
+        , unit_id
+        , geom
+      FROM pg_temp.restore_todo
+  ), val AS (
+    -- insert the measured values
+    INSERT INTO sos.numericvalue (observationid, value)
+      SELECT obs_id, m_value FROM pg_temp.restore_todo
+  ), offer AS (
+    -- insert the links to the offering
+    INSERT INTO sos.observationhasoffering (observationid, offeringid)
+      SELECT obs_id, offering_id FROM pg_temp.restore_todo
+  )
+  -- series metadata to update (updateseries)
+  INSERT INTO lml_import.series_dirty (seriesid, mintime, removed, ts_created)
+    SELECT series_id, min(enddatetime) AT TIME ZONE 'UTC', false, now()
+    FROM pg_temp.restore_todo
+    GROUP BY series_id;
+
+  -- keep track of the link between the source rows and sos observations
+  UPDATE lml_import.measurements m
+    SET sos_observationid = r.obs_id
+    FROM pg_temp.restore_todo r
+    WHERE m.id = r.id
+      AND m.sos_observationid IS DISTINCT FROM r.obs_id;
+
+  SELECT count(*) INTO n FROM pg_temp.restore_todo;
+  DROP TABLE pg_temp.restore_todo;
+  DROP TABLE pg_temp.restore_targets;
+  RETURN n;
+END;
+$$;
+
+
+--
+-- Name: run_metrics; Type: TABLE; Schema: lml_import; Owner: -
+-- Metrics per run of lml-retrieve.py, lml-prepare.py and lml-process.py (one row per metric, written
+-- at the end of the run): time per phase, files per xmlfile_insert result, bytes
+-- downloaded, http latency percentiles, observations published and unpublished.
+--
+
+CREATE TABLE IF NOT EXISTS run_metrics (
+    run_id character varying(36) NOT NULL,
+    script character varying(32),
+    metric text NOT NULL,
+    value double precision,
+    unit character varying(8),
+    ts_created timestamp with time zone,
+    PRIMARY KEY (run_id, metric)
+);
+
+CREATE INDEX IF NOT EXISTS run_metrics_ts_created_idx ON run_metrics USING btree (ts_created);
+
+
+--
+-- Name: partition_keys(); Type: FUNCTION; Schema: lml_import; Owner: -
+-- The tables that can be partitioned by month (partition_tables), with their time column.
+--
+
+CREATE OR REPLACE FUNCTION partition_keys() RETURNS TABLE(tablename text, columnname text)
+    LANGUAGE sql IMMUTABLE
+    AS $$
+  VALUES ('xml_files', 'ts_xmlfile')
+    , ('measurements', 'begindatetime')
+    , ('message_log', 'msgtimestamp');
+$$;
+
+
+--
+-- Name: create_partitions(timestamp with time zone, timestamp with time zone, text); Type: FUNCTION; Schema: lml_import; Owner: -
+-- Creates the missing monthly partitions (<table>_pYYYYMM) of the partitioned tables for
+-- the months from time_from up to and including time_to. Rows of a month that already
+-- went to the default partition stay there (the month is skipped). Tables that are not
+-- partitioned are left alone. Returns the number of created partitions.
+--
+
+CREATE OR REPLACE FUNCTION create_partitions(time_from timestamp with time zone, time_to timestamp with time zone, table_name text DEFAULT NULL) RETURNS integer
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+  k record;
+  month timestamp with time zone;
+  partition_name text;
+  in_default boolean;
+  n integer := 0;
+BEGIN
+  FOR k IN
+    SELECT p.tablename, p.columnname
+    FROM lml_import.partition_keys() p
+    JOIN pg_class c
+      ON c.oid = to_regclass('lml_import.' || p.tablename)
+    WHERE c.relkind = 'p'
+      AND (table_name IS NULL OR p.tablename = table_name)
+  LOOP
+    month := date_trunc('month', time_from);
+    WHILE month <= time_to LOOP
+      partition_name := k.tablename || '_p' || to_char(month, 'YYYYMM');
+      IF to_regclass('lml_import.' || partition_name) IS NULL THEN
+        EXECUTE format('SELECT EXISTS (SELECT 1 FROM lml_import.%I WHERE %I >= $1 AND %I < $2)'
+            , k.tablename || '_default', k.columnname, k.columnname)
+          INTO in_default
+          USING month, month + interval '1 month';
+        IF in_default THEN
+          RAISE NOTICE 'Partition % not created, the default partition has rows of this month', partition_name;
+        ELSE
+          EXECUTE format('CREATE TABLE lml_import.%I PARTITION OF lml_import.%I FOR VALUES FROM (%L) TO (%L)'
+            , partition_name, k.tablename, month, month + interval '1 month');
+          n := n + 1;
+        END IF;
+      END IF;
+      month := month + interval '1 month';
+    END LOOP;
+  END LOOP;
+  RETURN n;
+END;
+$$;
+
+
+--
+-- Name: partition_tables(); Type: FUNCTION; Schema: lml_import; Owner: -
+-- One time conversion of xml_files (ts_xmlfile), measurements (begindatetime) and
+-- message_log (msgtimestamp) to tables partitioned by month, with a default partition
+-- for the rest. The data is copied, indexes, triggers, comments and grants are recreated
+-- (unique indexes get the time column added, id is unique together with the time column;
+-- xmlfilename stays unique per file through xmlfile_store). The views that depend on the
+-- table, also through other views, are recreated with their indexes, triggers, comments
+-- and grants (owned by the converting user). Needs PostgreSQL 13 or later (row triggers
+-- on partitioned tables). Tables that are partitioned already are skipped. Returns the
+-- converted tables.
+--
+
+CREATE OR REPLACE FUNCTION partition_tables() RETURNS SETOF text
+    LANGUAGE plpgsql
+    SET search_path = lml_import, public
+    AS $_$
+DECLARE
+  k record;
+  tbl regclass;
+  seq text;
+  mintime timestamp with time zone;
+  ahead interval;
+  indexdefs text[];
+  triggerdefs text[];
+  viewdefs text[];
+  commentdefs text[];
+  grantdefs text[];
+  def text;
+BEGIN
+  IF current_setting('server_version_num')::integer < 130000 THEN
+    RAISE EXCEPTION 'Partitioning needs PostgreSQL 13 or later';
+  END IF;
+  ahead := coalesce((SELECT configvalue FROM lml_import.configuration WHERE key = 'lml.partition.ahead'), '2') || ' months';
+
+  FOR k IN SELECT * FROM lml_import.partition_keys() LOOP
+    tbl := to_regclass('lml_import.' || k.tablename);
+    CONTINUE WHEN (SELECT relkind FROM pg_class WHERE oid = tbl) <> 'r';
+
+    -- the dependent views, also views on views (dropped with the table), depth first
+    CREATE TEMPORARY TABLE partition_views ON COMMIT DROP AS
+      WITH RECURSIVE tree(oid, depth) AS (
+        SELECT tbl::oid, 0
+        UNION ALL
+        SELECT r.ev_class, t.depth + 1
+        FROM tree t
+        JOIN pg_depend d
+          ON d.refclassid = 'pg_class'::regclass
+          AND d.refobjid = t.oid
+          AND d.classid = 'pg_rewrite'::regclass
+        JOIN pg_rewrite r
+          ON r.oid = d.objid
+        WHERE r.ev_class <> t.oid
+      )
+      SELECT v.oid, v.relkind, max(t.depth) AS depth
+      FROM tree t
+      JOIN pg_class v
+        ON v.oid = t.oid
+      WHERE v.relkind IN ('v', 'm')
+      GROUP BY v.oid, v.relkind;
+
+    -- indexes, triggers, views, comments and grants, to recreate on the partitioned table
+    SELECT array_agg(CASE
+        WHEN i.indrelid <> tbl THEN pg_get_indexdef(i.indexrelid)
+        WHEN NOT i.indisunique THEN pg_get_indexdef(i.indexrelid)
+        WHEN pg_get_indexdef(i.indexrelid) LIKE '% WHERE %' THEN replace(pg_get_indexdef(i.indexrelid), 'CREATE UNIQUE INDEX', 'CREATE INDEX')
+        ELSE regexp_replace(pg_get_indexdef(i.indexrelid), '\)$', ', ' || quote_ident(k.columnname) || ')')
+        END)
+      INTO indexdefs
+      FROM pg_index i
+      WHERE (i.indrelid = tbl OR i.indrelid IN (SELECT oid FROM partition_views))
+        AND NOT i.indisprimary;
+    SELECT array_agg(pg_get_triggerdef(g.oid))
+      INTO triggerdefs
+      FROM pg_trigger g
+      WHERE (g.tgrelid = tbl OR g.tgrelid IN (SELECT oid FROM partition_views))
+        AND NOT g.tgisinternal;
+    SELECT array_agg(format('CREATE %s %s%s AS %s'
+        , CASE WHEN v.relkind = 'm' THEN 'MATERIALIZED VIEW' ELSE 'VIEW' END, c.oid::regclass
+        , CASE WHEN c.reloptions IS NOT NULL THEN format(' WITH (%s)', array_to_string(c.reloptions, ', ')) ELSE '' END
+        , pg_get_viewdef(c.oid)) ORDER BY v.depth)
+      INTO viewdefs
+      FROM partition_views v
+      JOIN pg_class c
+        ON c.oid = v.oid;
+    -- (column comments of the table are copied by LIKE)
+    SELECT array_agg(CASE
+        WHEN d.objsubid = 0 THEN format('COMMENT ON %s %s IS %L'
+          , CASE c.relkind WHEN 'm' THEN 'MATERIALIZED VIEW' WHEN 'v' THEN 'VIEW' ELSE 'TABLE' END, c.oid::regclass, d.description)
+        ELSE format('COMMENT ON COLUMN %s.%I IS %L', c.oid::regclass, a.attname, d.description)
+        END)
+      INTO commentdefs
+      FROM pg_class c
+      JOIN pg_description d
+        ON d.classoid = 'pg_class'::regclass
+        AND d.objoid = c.oid
+      LEFT JOIN pg_attribute a
+        ON a.attrelid = c.oid
+        AND a.attnum = d.objsubid
+      WHERE c.oid IN (SELECT oid FROM partition_views)
+        OR (c.oid = tbl AND d.objsubid = 0);
+    SELECT array_agg(format('GRANT %s ON %s TO %s%s', a.privilege_type, c.oid::regclass
+        , CASE WHEN a.grantee = 0 THEN 'PUBLIC' ELSE quote_ident(pg_get_userbyid(a.grantee)) END
+        , CASE WHEN a.is_grantable THEN ' WITH GRANT OPTION' ELSE '' END))
+      INTO grantdefs
+      FROM pg_class c
+      CROSS JOIN aclexplode(c.relacl) a
+      WHERE c.oid = tbl
+        OR c.oid IN (SELECT oid FROM partition_views);
+    DROP TABLE partition_views;
+
+    -- the sequence of id is kept
+    seq := pg_get_serial_sequence(tbl::text, 'id');
+    IF seq IS NOT NULL THEN
+      EXECUTE format('ALTER SEQUENCE %s OWNED BY NONE', seq);
+    END IF;
+
+    EXECUTE format('ALTER TABLE %s RENAME TO %I', tbl, k.tablename || '_unpartitioned');
+    EXECUTE format('CREATE TABLE lml_import.%I (LIKE lml_import.%I INCLUDING DEFAULTS INCLUDING COMMENTS) PARTITION BY RANGE (%I)'
+      , k.tablename, k.tablename || '_unpartitioned', k.columnname);
+    EXECUTE format('CREATE TABLE lml_import.%I PARTITION OF lml_import.%I DEFAULT'
+      , k.tablename || '_default', k.tablename);
+    EXECUTE format('SELECT min(%I) FROM lml_import.%I', k.columnname, k.tablename || '_unpartitioned')
+      INTO mintime;
+    PERFORM lml_import.create_partitions(coalesce(mintime, now()), now() + ahead, k.tablename);
+
+    -- copy (no triggers yet), indexes are built afterwards
+    EXECUTE format('INSERT INTO lml_import.%I SELECT * FROM lml_import.%I', k.tablename, k.tablename || '_unpartitioned');
+    EXECUTE format('DROP TABLE lml_import.%I CASCADE', k.tablename || '_unpartitioned');
+    IF seq IS NOT NULL THEN
+      EXECUTE format('ALTER SEQUENCE %s OWNED BY lml_import.%I.id', seq, k.tablename);
+    END IF;
+
+    EXECUTE format('CREATE UNIQUE INDEX %I ON lml_import.%I USING btree (id, %I)'
+      , k.tablename || '_id_key', k.tablename, k.columnname);
+    FOREACH def IN ARRAY coalesce(viewdefs, '{}') || coalesce(indexdefs, '{}') || coalesce(triggerdefs, '{}')
+        || coalesce(commentdefs, '{}') || coalesce(grantdefs, '{}') LOOP
+      EXECUTE def;
+    END LOOP;
+    RETURN NEXT k.tablename;
+  END LOOP;
+END;
+$_$;
+
+
+--
+-- Name: apply_retention(); Type: FUNCTION; Schema: lml_import; Owner: -
+-- Maintenance in one call: creates the partitions of the coming months (lml.partition.ahead,
+-- default 2), and removes the data older than lml.retention.<table> months (0 or no key:
+-- kept) from xml_files, measurements and message_log. Whole months are dropped as partition,
+-- the rest is deleted (tables that are not partitioned, the default partitions).
+-- Removing measurements does not unpublish them, the observations stay in the SOS.
+-- Returns what was done per table and partition.
+--
+
+CREATE OR REPLACE FUNCTION apply_retention() RETURNS TABLE(relation text, action text, rows_removed bigint)
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+  k record;
+  p record;
+  months integer;
+  cutoff timestamp with time zone;
+  partitioned boolean;
+BEGIN
+  -- the delete triggers of measurements leave the sos alone
+  PERFORM set_config('lml_import.retention', 'on', true);
+
+  PERFORM lml_import.create_partitions(now()
+    , now() + (coalesce((SELECT configvalue FROM lml_import.configuration WHERE key = 'lml.partition.ahead'), '2') || ' months')::interval);
+
+  FOR k IN SELECT * FROM lml_import.partition_keys() LOOP
+    months := coalesce((SELECT configvalue FROM lml_import.configuration WHERE key = 'lml.retention.' || k.tablename), '0');
+    CONTINUE WHEN months <= 0;
+    cutoff := date_trunc('month', now()) - (months || ' months')::interval;
+    partitioned := (SELECT relkind FROM pg_class WHERE oid = to_regclass('lml_import.' || k.tablename)) = 'p';
+
+    IF partitioned THEN
+      FOR p IN
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c
+          ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass('lml_import.' || k.tablename)
+          AND c.relname ~ ('^' || k.tablename || '_p[0-9]{6}$')
+          AND to_timestamp(right(c.relname, 6), 'YYYYMM') + interval '1 month' <= cutoff
+        ORDER BY c.relname
+      LOOP
+        EXECUTE format('DROP TABLE lml_import.%I', p.relname);
+        relation := p.relname;
+        action := 'dropped';
+        rows_removed := NULL;
+        RETURN NEXT;
+      END LOOP;
+      relation := k.tablename || '_default';
+    ELSE
+      relation := k.tablename;
+    END IF;
+
+    EXECUTE format('DELETE FROM lml_import.%I WHERE %I < $1', relation, k.columnname) USING cutoff;
+    GET DIAGNOSTICS rows_removed = ROW_COUNT;
+    action := 'deleted';
+    RETURN NEXT;
+  END LOOP;
+END;
+$$;
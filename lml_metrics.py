@@ -0,0 +1,57 @@
+#==============================================================================
+#title           :lml_metrics.py
+#description     :Metrics of a run (table run_metrics), shared by
+#                 lml-retrieve.py, lml-prepare.py and lml-process.py.
+#version         :1.1
+#usage           :from lml_metrics import RunMetrics
+#python_version  :2.7.x
+#==============================================================================
+
+import time, uuid
+import threading
+from sos_config import SCHEMA
+
+# Metrics of the run (table run_metrics), written in one batch at the end
+# (add: sums a value, e.g. a count or the time of a phase; sample: keeps the value for
+# percentiles, e.g. http latency; thread safe)
+class RunMetrics:
+  def __init__(self, script):
+    self.script = script
+    self.runid = str(uuid.uuid4())
+    self.lock = threading.Lock()
+    self.values = {}
+    self.samples = {}
+    self.started = {}
+
+  def add(self, metric, value, unit=''):
+    with self.lock:
+      self.values[metric] = (self.values.get(metric, (0, unit))[0] + value, unit)
+
+  def sample(self, metric, value, unit=''):
+    with self.lock:
+      self.samples.setdefault(metric, (unit, []))[1].append(value)
+
+  def start(self, phase):
+    self.started[phase] = time.time()
+
+  def stop(self, phase):
+    self.add('phase.' + phase, time.time() - self.started.pop(phase), 's')
+
+  def rows(self):
+    rows = [(metric, float(v[0]), v[1]) for metric, v in self.values.items()]
+    for metric, (unit, values) in self.samples.items():
+      values = sorted(values)
+      for name, p in [('p50', 0.5), ('p90', 0.9), ('p99', 0.99)]:
+        rows.append((metric + '.' + name, float(values[min(len(values) - 1, int(p * len(values)))]), unit))
+      rows.append((metric + '.max', float(values[-1]), unit))
+      rows.append((metric + '.count', float(len(values)), ''))
+    return sorted(rows)
+
+  # (schema qualified: lml-prepare.py rolls back its search_path)
+  def store(self, pgcur):
+    rows = self.rows()
+    sql = "INSERT INTO " + SCHEMA + """.run_metrics (run_id, script, metric, value, unit, ts_created)
+      SELECT %s, %s, u.metric, u.value, u.unit, now()
+      FROM unnest(%s::text[], %s::double precision[], %s::text[]) AS u(metric, value, unit);"""
+    pgcur.execute(sql, (self.runid, self.script, [r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows]))
+# The end